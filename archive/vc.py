@@ -20,9 +20,9 @@ args = parser.parse_args()
 
 # return postion of sync clap in ms
 def find_sync_clap(raw, rate):
-    for i, s in enumerate(raw):
-        if abs(s) > 10000:
-            return (i * 1000) / rate
+    loud = np.flatnonzero(np.abs(np.asarray(raw, dtype=np.int32)) > 10000)
+    if len(loud):
+        return (loud[0] * 1000) / rate
 
 # load samples, convert to mono, and normalize
 print("loading samples...")
@@ -5,40 +5,307 @@ import librosa
 import librosa.display
 import math
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
-from pydub import AudioSegment, scipy_effects # pip install pydub
+from pydub import AudioSegment # pip install pydub
 from pydub.playback import play
 from scipy import signal
+from scipy.io import wavfile
+import subprocess
 from subprocess import call
 from tqdm import tqdm
 
+from . import claps
+from . import correlate
+from .correlate import FFTCorrelator
+from . import drift
+from . import events
+from .features import FeatureStore
 from .logger import log
+from .manifest import Manifest
+from .pair_cache import PairCache
 from . import scan
 
 sample_rate = 48000
 hop_length = 512
+# the mono analysis signals are band limited to mono_band, so all the
+# feature extraction and correlation runs on a decimated copy of them.
+# analysis_rate must divide sample_rate, the analysis hop covers the same
+# time as hop_length does at the full rate (and should stay a multiple
+# of 64 for chroma_cqt.)
+analysis_rate = 12000
+analysis_hop = hop_length * analysis_rate // sample_rate
+coarse_decimate = 8             # coarse pass resolution of search="coarse"
+outlier_threshold = 0.05        # sec, median pair residual to flag a track
+# psr (on the mean removed correlation) of synthetic 3-6 minute clarity
+# tracks: about 16-21 for correctly aligned pairs (even with noisy,
+# patchy singers), 2-6.5 for unrelated pairs
+fallback_psr = 8.0              # pairs below this psr try onset events too
+report_psr = 10.0               # tracks below this psr fail the report
+fallback_confidence = 10.0      # onset event confidence needed to use them
+canon_band = [80, 4500]         # Hz, band pass of the canonical audio
+canon_limit = 31000             # peak level limit of the canonical audio
+mono_band = [130, 523]          # Hz, band pass of the analysis signal (C3-C5)
+filter_block = 1048576          # frames per block of the streaming filters
+
+# parameters that each kind of cached artifact / feature is made with.
+# These are part of its signature in the cache manifest (or the feature
+# store), so changing any of them invalidates the cached versions.
+canon_params = { "rate": sample_rate, "channels": 2, "headroom": 0.1,
+                 "band": canon_band, "limit": canon_limit }
+mono_params = { "canon": canon_params, "band": mono_band, "order": 5,
+                "rate": analysis_rate, "dtype": "float32" }
+onset_params = { "mono": mono_params, "hop": analysis_hop }
+intensity_params = { "mono": mono_params, "hop": analysis_hop }
+chroma_params = { "mono": mono_params, "hop": analysis_hop, "kind": "cqt" }
+clarity_params = { "chroma": chroma_params, "intensity": intensity_params,
+                   "threshold": 0.2 }
+rms_params = { "intensity": intensity_params, "floor": 0.05, "scale": 4 }
+drift_params = { "window_sec": 20, "step_sec": 10, "band_sec": 1.0,
+                 "min_psr": 4, "tolerance": 0.04, "min_drift": 0.08,
+                 "min_margin": 0.02 }
+
+# the parameter set of each feature that can be correlated by name, part
+# of the key of cached results derived from that feature
+feature_params = { "onset": onset_params, "intensity": intensity_params,
+                   "clarity": clarity_params, "rms": rms_params }
+
+# duration (sec) of a media file according to ffprobe, or None
+def ffprobe_duration(path):
+    command = [ "ffprobe", "-v", "error", "-show_entries", "format=duration",
+                "-of", "default=noprint_wrappers=1:nokey=1", path ]
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        return float(result.stdout.decode().strip())
+    except Exception:
+        return None
+
+# decode the audio of any file ffmpeg understands straight into an int16
+# (frames, channels) numpy array, resampled to rate by ffmpeg.  The raw
+# pcm stream is read directly into a buffer preallocated from the probed
+# duration (grown if needed) so there are no intermediate copies.
+def ffmpeg_decode(path, rate, channels):
+    duration = ffprobe_duration(path)
+    if duration is None:
+        duration = 60
+    buf = np.empty(int((duration + 1) * rate) * channels, dtype=np.int16)
+    command = [ "ffmpeg", "-v", "error", "-i", path, "-vn",
+                "-f", "s16le", "-acodec", "pcm_s16le",
+                "-ac", str(channels), "-ar", str(rate), "-" ]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    count = 0
+    while True:
+        if count == buf.nbytes:
+            # estimate was short, grow the buffer
+            bigger = np.empty(len(buf) * 2, dtype=np.int16)
+            bigger[:len(buf)] = buf
+            buf = bigger
+        with memoryview(buf).cast('B') as view:
+            n = proc.stdout.readinto(view[count:])
+        if not n:
+            break
+        count += n
+    proc.wait()
+    if proc.returncode != 0:
+        raise Exception("ffmpeg decode failed, result code: %d" % proc.returncode)
+    frames = count // (2 * channels)
+    return buf[:frames*channels].reshape(frames, channels)
+
+# max absolute value of each block of a raw signal (the last block may
+# be partial).  max(abs()) is computed as max(max, -min) of each block so
+# the whole track is never copied.
+def block_max(raw, block):
+    x = np.asarray(raw)
+    full = (len(x) // block) * block
+    blocks = x[:full].reshape(-1, block)
+    result = np.maximum(blocks.max(axis=1).astype('float'),
+                        -blocks.min(axis=1).astype('float'))
+    if full < len(x):
+        tail = np.max(np.abs(x[full:].astype('float')))
+        result = np.append(result, tail)
+    return result
+
+# run a filter over x (along axis 0) in blocks of frames, carrying the
+# filter state from one block to the next, and yield (start, filtered
+# block) for each.  The concatenated output is bit identical to
+# signal.sosfilt(sos, x, axis=0), but only one block is in memory at a
+# time.  prepare() optionally converts each input block first.
+def sosfilt_blocks(sos, x, prepare=None, block=filter_block):
+    zi = None
+    for base in range(0, len(x), block):
+        chunk = x[base:base+block]
+        if prepare is not None:
+            chunk = prepare(chunk)
+        if zi is None:
+            zi = np.zeros((sos.shape[0], 2) + chunk.shape[1:])
+        y, zi = signal.sosfilt(sos, chunk, axis=0, zi=zi)
+        yield base, y
+
+# value at the given fraction of the sorted array (without sorting it)
+def low_percentile(x, frac=0.05):
+    index = int(round(len(x)*frac))
+    return np.partition(x, index)[index]
+
+# per frame clarity (number of chroma bins that are clearly not
+# sounding, scaled by intensity) and dominant note (scaled by relative
+# intensity) from a chroma matrix
+def clarity_notes(chroma, intensity, frames):
+    num = np.min([frames, len(intensity), chroma.shape[1]])
+    imax = np.max(intensity)
+    chroma = chroma[:,:num]
+    intensity = intensity[:num]
+    notes = np.argmax(chroma, axis=0) * (intensity / imax)
+    clarity = (chroma < clarity_params["threshold"]).sum(axis=0) * intensity
+    return clarity, notes
+
+# hysteresis detector: a frame turns the state active when x > upper
+# and inactive when x < lower, frames in between keep the previous
+# state.  Returns the runs of constant state (from the first frame that
+# decides a state) as start/end index arrays (inclusive) plus the state
+# of each run.
+def hysteresis_runs(x, lower, upper):
+    x = np.asarray(x)
+    state = np.zeros(len(x), dtype=np.int8)
+    state[x < lower] = -1
+    state[x > upper] = 1
+    decided = np.flatnonzero(state)
+    if not len(decided):
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, np.zeros(0, dtype=bool)
+    # latch the last decided state forward over the undecided frames
+    last = np.maximum.accumulate(np.where(state != 0, np.arange(len(x)), 0))
+    latched = state[last][decided[0]:] > 0
+    changes = np.flatnonzero(np.diff(latched)) + 1 + decided[0]
+    starts = np.concatenate([[decided[0]], changes])
+    ends = np.concatenate([changes - 1, [len(x) - 1]])
+    return starts, ends, latched[starts - decided[0]]
+
+# process pool worker: load and canonicalize one track (and fill its
+# cache entries.)  Errors are returned rather than raised so one bad
+# track doesn't take down the whole batch.  The cache manifest changes
+# are returned too and saved once by the parent process.
+def prepare_track_worker(task):
+    (path, file) = task
+    group = SampleGroup(path)
+    try:
+        group.prepare_track(file)
+        return file, None, group.get_manifest().changes
+    except Exception as e:
+        return file, str(e), group.get_manifest().changes
+
+# process pool initializer for the feature extraction workers: the pool
+# is the parallelism, so each worker keeps its BLAS/OpenMP and numba
+# thread pools to one thread instead of every worker trying to use every
+# core.
+def limit_worker_threads():
+    for var in [ "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                 "MKL_NUM_THREADS", "NUMBA_NUM_THREADS" ]:
+        os.environ[var] = "1"
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+    try:
+        import numba
+        numba.set_num_threads(1)
+    except Exception:
+        pass
+
+# process pool worker: compute the onset, chroma and clarity features of
+# one track (the results go straight into its feature store.)
+def extract_features_worker(task):
+    (path, file) = task
+    try:
+        group = SampleGroup(path)
+        group.name_list = [ file ]
+        group.sample_list = [ group.load_canonical(file) ]
+        group.compute_onset()
+        group.compute_clarities()
+        return file, None
+    except Exception as e:
+        return file, str(e)
+
+# l[i] as a float (for json), or None if missing
+def list_value(l, i):
+    if i < len(l) and l[i] is not None:
+        return float(l[i])
+    return None
+
+# a SampleGroup feature (per track list) that is computed on first use
+# by the named compute method and kept after that.  Compute methods just
+# use the features they depend on, so those are computed on demand too,
+# and a run only computes what its sync method and the mixer really use.
+class LazyFeature():
+    def __init__(self, compute):
+        self.compute = compute
+
+    def __set_name__(self, owner, name):
+        self.attr = "_" + name
+
+    def __get__(self, group, owner=None):
+        if group is None:
+            return self
+        if getattr(group, self.attr, None) is None:
+            getattr(group, self.compute)()
+        return getattr(group, self.attr)
+
+    def __set__(self, group, value):
+        setattr(group, self.attr, value)
 
 class SampleGroup():
-    def __init__(self, path):
+    sample_list = LazyFeature("load_samples")
+    raw_list = LazyFeature("compute_raw")
+    onset_list = LazyFeature("compute_onset")
+    time_list = LazyFeature("compute_times")
+    intensity_list = LazyFeature("compute_intensities")
+    clarity_list = LazyFeature("compute_clarities")
+    note_list = LazyFeature("compute_clarities")
+    rms_list = LazyFeature("compute_rms")
+    event_list = LazyFeature("compute_events")
+    envelope_list = LazyFeature("compute_envelopes")
+    suppress_list = LazyFeature("compute_envelopes")
+
+    def __init__(self, path, jobs=1, search="full", max_offset=None,
+                 hints={}):
         self.path = path
+        self.jobs = jobs
+        self.search = search
+        self.max_offset = max_offset
+        self.hints = hints
         self.name_list = []
         self.video_list = []
-        self.sample_list = []
-        self.raw_list = []
-        self.onset_list = []
-        self.time_list = []
+        self.aligned_list = []
         self.beat_list = []
         self.offset_list = []
-        self.intensity_list = []
-        self.clarity_list = []
-        self.rms_list = []
-        self.note_list = []
-        self.envelope_list = []
+        self.residual_list = []
+        self.outlier_list = []
+        self.psr_list = []
+        self.second_list = []
+        self.fallback_list = []
+        self.drift_list = []
+        self.mix_raw = None
+        self.chroma_list = []
+        # lazy features (None = not computed yet)
+        self.sample_list = None
+        self.raw_list = None
+        self.onset_list = None
+        self.time_list = None
+        self.intensity_list = None
+        self.clarity_list = None
+        self.note_list = None
+        self.rms_list = None
+        self.event_list = None
+        self.envelope_list = None
         self.suppress_list = None
         self.leadin_list = []
         self.fadeout_list = []
         self.sync_file = None
+        self.manifest = None
+        self.stores = {}
 
     def load_all_samples_deprecated(self):
         audio_tracks, video_tracks, sync_file = scan.scan_directory(self.path)
@@ -78,6 +345,23 @@ class SampleGroup():
             log("Creating:", cache_dir)
             os.makedirs(cache_dir)
         return cache_dir
+
+    # cache manifest of this group (created on first use)
+    def get_manifest(self):
+        if self.manifest is None:
+            self.manifest = Manifest(self.check_cache())
+        return self.manifest
+
+    # content hash of a source track
+    def source_hash(self, file):
+        return scan.file_hash(os.path.join(self.path, file))
+
+    # feature store of a track
+    def features(self, file):
+        if not file in self.stores:
+            self.stores[file] = FeatureStore(self.check_cache(), file,
+                                             self.source_hash(file))
+        return self.stores[file]
         
     def scan(self):
         audio_tracks, video_tracks, sync_file = scan.scan_directory(self.path)
@@ -86,176 +370,282 @@ class SampleGroup():
         self.video_list = video_tracks
         self.sync_file = sync_file
 
-    def filter_extremes(self, sample):
-        channels = sample.split_to_mono()
-        raws = []
-        for ch in channels:
-            raws.append( ch.get_array_of_samples() )
-        sos = signal.butter(4, [80, 4500], 'bp', fs=sample.frame_rate, output='sos')
-        filtered = []
-        for raw in raws:
-            filt = signal.sosfilt(sos, raw).astype(float)
-            max = np.max(np.abs(filt))
-            if max > 31000:
-                filt *= (31000/max)
-            #print("max:", np.max(np.abs(filt)))
-            filt = np.int16( filt )
-            seg = AudioSegment(filt.tobytes(), frame_rate=sample.frame_rate, sample_width=2, channels=1)
-            filtered.append( seg )
-        result = AudioSegment.from_mono_audiosegments(*filtered)
-        return result
-        
-    def load(self, file):
+    # band pass each channel of an int16 (frames, channels) array (scaled
+    # by gain), limit the peak level, and write the result into out.  The
+    # filter is streamed over the track twice (once to find the filtered
+    # peak, once to write) so no full length float copy is ever made.
+    # (Nothing is filtered in place: each block is converted to float
+    # and sosfilt() returns a new filtered block.)
+    def filter_extremes(self, raw, gain, out):
+        sos = signal.butter(4, canon_band, 'bp', fs=sample_rate, output='sos')
+        def prepare(chunk):
+            y = chunk.astype(np.float32)
+            if gain is not None:
+                y *= gain
+            return y
+        max = np.float32(0)
+        for base, y in sosfilt_blocks(sos, raw, prepare):
+            max = np.maximum(max, np.max(np.abs(y.astype(np.float32))))
+        for base, y in sosfilt_blocks(sos, raw, prepare):
+            y = y.astype(np.float32)
+            if max > canon_limit:
+                y *= (canon_limit/max)
+            out[base:base+len(y)] = np.int16(y)
+        #print("max:", np.max(np.abs(out)))
+        return out
+
+    # name of a cache file for a track
+    def cache_file(self, file, suffix):
+        name = os.path.basename(file)
+        basename, ext = os.path.splitext(name)
+        return os.path.join(self.path, "cache", basename + suffix)
+
+    # decode a track and convert it to canonical form: 48 kHz stereo
+    # int16 (frames, channels) array, normalized and band passed, written
+    # straight to the out_name .npy file.  Returns the (memory mapped)
+    # result.
+    def load(self, file, out_name):
         log("loading audio track:", file)
-        basename, ext = os.path.splitext(file)
-        # print(self.path, basename, ext)
+        # print(self.path, file)
         path = os.path.join(self.path, file)
 
         if not os.path.exists(path):
             return None
-        
-        if ext == ".aif":
-            ext = ".aiff"
-        elif ext == ".mpeg" or ext == ".m4v":
-            ext = ".mp4"
+
         try:
-            sample = AudioSegment.from_file(path, ext[1:])
+            raw = ffmpeg_decode(path, sample_rate, 2)
+            if not len(raw):
+                raise Exception("no audio samples found")
         except Exception as e:
             # create a song of silence if sample load fails
             log("NOTICE: loading audio failed for:", file)
             log(str(e))
-            sample = AudioSegment.silent(duration=10000)
-        sample = sample.set_channels(2) # force samples to be stereo
-        sample = sample.set_sample_width(2) # force to 2 for this project
-        sample = sample.normalize()
-        sample = sample.set_frame_rate(sample_rate)
-        sample = self.filter_extremes(sample)
-        return sample
+            raw = np.zeros((10*sample_rate, 2), dtype=np.int16)
+        return self.canonicalize(raw, out_name)
+
+    # normalize a 48 kHz stereo (frames, channels) array (same 0.1 dB
+    # headroom as pydub normalize()) and filter it block by block into
+    # the canonical form, written to the out_name .npy file.  Returns the
+    # (memory mapped) result.
+    def canonicalize(self, raw, out_name):
+        peak = np.float32(np.max([int(np.max(raw)), -int(np.min(raw))]))
+        gain = None
+        if peak > 0:
+            gain = (32768 * math.pow(10, -0.1/20)) / peak
+        out = np.lib.format.open_memmap(out_name, mode='w+',
+                                        dtype=np.int16, shape=raw.shape)
+        self.filter_extremes(raw, gain, out)
+        out.flush()
+        return out
+
+    # the lossless canonical audio store: "canon" (or "clean" after
+    # noise reduction) audio of a track memory mapped from the cache, or
+    # None if it doesn't exist
+    def load_canonical(self, file, kind="canon"):
+        name = self.cache_file(file, "-" + kind + ".npy")
+        if not os.path.exists(name):
+            return None
+        return np.load(name, mmap_mode='r')
+
+    # same, but as an AudioSegment (for the pydub based mixing)
+    def canonical_sample(self, file, kind="canon"):
+        raw = self.load_canonical(file, kind)
+        if raw is None:
+            return None
+        return AudioSegment(raw.tobytes(), frame_rate=sample_rate,
+                            sample_width=2, channels=raw.shape[1])
+
+    # put audio that is already in memory (the lossless mix of a sub
+    # group, a 48 kHz stereo (frames, channels) array) into the canonical
+    # store as the given track of this group, versioned by the content
+    # hash of the track file.  The (lossy) track file then never needs to
+    # be decoded, and the analysis features come from the lossless audio.
+    def import_track(self, file, raw):
+        log("importing lossless audio for:", file)
+        manifest = self.get_manifest()
+        canon_name = self.cache_file(file, "-canon.npy")
+        out = self.canonicalize(raw, canon_name)
+        manifest.update(os.path.basename(canon_name), self.source_hash(file),
+                        canon_params)
+        manifest.save()
+        self.mono_filter(file, out)
+
+    # load one track, convert to canonical form and save that in the
+    # cache, and make sure the mono/filtered analysis signal is cached
+    # too.  Returns the (memory mapped) canonical audio.
+    def prepare_track(self, file):
+        # check cache
+        manifest = self.get_manifest()
+        source = self.source_hash(file)
+        canon_name = self.cache_file(file, "-canon.npy")
+        key = os.path.basename(canon_name)
+        if not manifest.is_current(key, source, canon_params, canon_name):
+            # save canonical version of audio in cache
+            if self.load(file, canon_name) is not None:
+                manifest.update(key, source, canon_params)
+        raw = self.load_canonical(file)
+        self.mono_filter(file, raw)
+        return raw
 
     def load_samples(self):
         cache_dir = self.check_cache()
         
         log("Load original samples and convert to canonical form...")
+        tasks = []
+        for file in self.name_list:
+            tasks.append( (self.path, file) )
+        if self.jobs > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(min(self.jobs, len(tasks))) as pool:
+                results = pool.map(prepare_track_worker, tasks, chunksize=1)
+        else:
+            results = [ prepare_track_worker(task) for task in tasks ]
+        # results come back in name_list order, the audio itself is
+        # memory mapped from the canonical store
+        manifest = self.get_manifest()
         self.sample_list = []
-        for i, file in enumerate(self.name_list):
-            # check cache
-            fullname = os.path.join(self.path, file)
-            name = os.path.basename(file)
-            basename, ext = os.path.splitext(name)
-            canon_name = os.path.join(self.path, "cache",
-                                      basename + "-canon.mp3")
-            sample = self.load(file)
-            self.sample_list.append(sample)
-            if not self.is_newer(canon_name, fullname):
-                # save canonical version of audio in cache
-                sample.export(canon_name, format="mp3")
-        
+        for file, error, changes in results:
+            manifest.merge(changes)
+            raw = None
+            if error is None:
+                raw = self.load_canonical(file)
+            else:
+                log("NOTICE: preparing track failed, using silence:", file)
+                log(error)
+            if raw is None:
+                raw = np.zeros((10*sample_rate, 2), dtype=np.int16)
+            self.sample_list.append(raw)
+        manifest.save()
+
+    # mono/filtered analysis signal for a track (from the feature store if
+    # it is current, otherwise computed from the canonical audio and
+    # stored.)  This is a float32 array memory mapped from the store,
+    # that every feature computation shares without copying it.
+    def mono_filter(self, file, raw):
+        # check cache
+        store = self.features(file)
+        if not store.has("mono", mono_params):
+            # compute (streamed block by block straight into the store)
+            log("Generating mono/filtered sample:", file)
+            q = sample_rate // analysis_rate
+            sos = signal.butter(mono_params["order"], mono_band, 'bp',
+                                fs=sample_rate, output='sos')
+            if q > 1:
+                # anti alias low pass for the decimation, cascaded into
+                # the same streaming filter (same as scipy decimate())
+                sos = np.concatenate([sos, signal.cheby1(8, 0.05, 0.8/q,
+                                                         output='sos')])
+            mono_filt = store.create("mono", ((len(raw)+q-1)//q,), np.float32)
+            to_mono = lambda chunk: np.mean(chunk, axis=1)
+            for base, y in sosfilt_blocks(sos, raw, to_mono):
+                # keep every q'th sample of the whole track
+                y = y[(-base) % q::q]
+                n = (base + q - 1) // q
+                mono_filt[n:n+len(y)] = y
+            mono_filt.flush()
+            del mono_filt
+            store.commit("mono", mono_params)
+        return store.load("mono", mono_params)
+
     def compute_raw(self):
         cache_dir = self.check_cache()
         
         log("Generating raw signals...")
         self.raw_list = []
         for i, file in enumerate(self.name_list):
-            # check cache
-            fullname = os.path.join(self.path, file)
-            name = os.path.basename(file)
-            basename, ext = os.path.splitext(name)
-            canon_name = os.path.join(self.path, "cache",
-                                      basename + "-canon.mp3")
-            mono_name = os.path.join(self.path, "cache",
-                                     basename + "-monofilt.npy")
-            if self.is_newer(mono_name, canon_name):
-                # print("loading from cache:", mono_name)
-                with open(mono_name, "rb") as f:
-                    raw = np.load(f)
-            else:
-                # compute
-                log("Generating mono/filtered sample:", mono_name)
-                sample = self.sample_list[i]
-                mono = sample.set_channels(1) # convert to mono
-                mono_filt = scipy_effects.band_pass_filter(mono, 130, 523) #C3-C5
-                raw = mono_filt.get_array_of_samples()
-                # save in cache
-                with open(mono_name, "wb") as f:
-                    np.save(f, raw)
+            raw = self.mono_filter(file, self.sample_list[i])
             self.raw_list.append(raw)
             
+    # compute the onset, chroma and clarity features of the tracks that
+    # need them in a pool of worker processes, one track per task.  The
+    # results land in the feature stores and compute_onset() and
+    # compute_clarities() pick them up from there.
+    def extract_features(self):
+        if self.jobs <= 1:
+            return
+        tasks = []
+        for file in self.name_list:
+            store = self.features(file)
+            if not store.has("onset", onset_params) \
+               or not store.has("clarity", clarity_params) \
+               or not store.has("notes", clarity_params):
+                tasks.append( (self.path, file) )
+        if len(tasks) < 2:
+            return
+        # make sure the canonical and mono signals the workers start
+        # from are in the cache
+        self.raw_list
+        log("Extracting features for", len(tasks), "tracks, jobs:", self.jobs)
+        with multiprocessing.Pool(min(self.jobs, len(tasks)),
+                                  initializer=limit_worker_threads) as pool:
+            for file, error in tqdm(pool.imap_unordered(extract_features_worker, tasks),
+                                    total=len(tasks)):
+                if error is not None:
+                    log("NOTICE: feature extraction failed for:", file)
+                    log(error)
+        # the workers updated the stores on disk
+        self.stores = {}
+
     def compute_onset(self):
-        print("Computing onset envelope and times...")
+        self.extract_features()
+        print("Computing onset envelopes...")
         self.onset_list = []
-        self.time_list = []
         for i, raw in enumerate(tqdm(self.raw_list)):
-            # compute onset envelopes
-            oenv = librosa.onset.onset_strength(y=np.array(raw).astype('float'),
-                                                sr=sample_rate,
-                                                hop_length=hop_length)
-            t = librosa.times_like(oenv, sr=sample_rate, hop_length=hop_length)
+            store = self.features(self.name_list[i])
+            oenv = store.load("onset", onset_params)
+            if oenv is None:
+                # compute onset envelopes
+                oenv = librosa.onset.onset_strength(y=raw,
+                                                    sr=analysis_rate,
+                                                    hop_length=analysis_hop)
+                store.save("onset", onset_params, oenv)
             self.onset_list.append(oenv)
-            self.time_list.append(t)
+
+    # times of the analysis frames (the same frames as the onset
+    # envelope and chroma, but without having to compute them)
+    def compute_times(self):
+        self.time_list = []
+        for raw in self.raw_list:
+            frames = 1 + len(raw) // analysis_hop
+            self.time_list.append( np.arange(frames) * analysis_hop / analysis_rate )
             
     def compute_intensities(self):
         print("Computing intensities...")
         self.intensity_list = []
-        for raw in tqdm(self.raw_list):
-            intensity = []
-            base = 0
-            while base < len(raw):
-                intensity.append(np.max(np.abs(raw[base:base+hop_length])))
-                base += hop_length
-            self.intensity_list.append( np.array(intensity).astype('float') )
-
-    # return true if a is newer or same age than b, else false
-    def is_newer(self, a, b):
-        if os.path.exists(a) and os.path.exists(b):
-            stat_a = os.stat(a)
-            mtime_a = stat_a.st_mtime
-            stat_b = os.stat(b)
-            mtime_b = stat_b.st_mtime
-            if mtime_a >= mtime_b:
-                return True
-        return False
+        for i, raw in enumerate(tqdm(self.raw_list)):
+            store = self.features(self.name_list[i])
+            intensity = store.load("intensity", intensity_params)
+            if intensity is None:
+                intensity = block_max(raw, analysis_hop)
+                store.save("intensity", intensity_params, intensity)
+            self.intensity_list.append(intensity)
 
     def compute_clarities(self):
-        cache_dir = self.check_cache()
-        
+        self.extract_features()
         log("Computing clarities...")
         self.clarity_list = []
+        self.note_list = []
         self.chroma_list = []
         for i, raw in enumerate(tqdm(self.raw_list)):
             # check cache
-            fullname = os.path.join(self.path, self.name_list[i])
-            name = os.path.basename(self.name_list[i])
-            basename, ext = os.path.splitext(name)
-            cachename = os.path.join(self.path, "cache",
-                                     basename + ".clarity")
-            if self.is_newer(cachename, fullname):
-                # load from cache
-                #print("loading from cache:", cachename)
-                with open(cachename, "rb") as f:
-                    clarity = np.load(f)
-            else:
-                # compute
-                chroma = librosa.feature.chroma_cqt(y=np.array(raw).astype('float'),
-                                                    sr=sample_rate,
-                                                    hop_length=hop_length)
+            store = self.features(self.name_list[i])
+            clarity = store.load("clarity", clarity_params)
+            notes = store.load("notes", clarity_params)
+            if clarity is None or notes is None:
+                chroma = store.load("chroma", chroma_params)
+                if chroma is None:
+                    # compute
+                    chroma = librosa.feature.chroma_cqt(y=raw,
+                                                        sr=analysis_rate,
+                                                        hop_length=analysis_hop)
+                    store.save("chroma", chroma_params, chroma)
                 self.chroma_list.append(chroma)
-                a = len(self.time_list[i])
-                b = len(self.intensity_list[i])
-                c = chroma.shape[1]
-                min = np.min([a, b, c])
-                notes = np.zeros(min)
-                clarity = np.zeros(min)
-                imax = np.max(self.intensity_list[i])
-                for j in range(min):
-                    notes[j] = np.argmax(chroma[:,j]) * (self.intensity_list[i][j] / imax)
-                    clarity[j] = (chroma[:,j] < 0.2).sum() * self.intensity_list[i][j]
-                self.note_list.append(notes.T)
-                clarity = clarity.T
-                # save in cache
-                #print("saving clarity as:", cachename)
-                with open(cachename, "wb") as f:
-                    np.save(f, clarity.T)
+                clarity, notes = clarity_notes(chroma,
+                                               self.intensity_list[i],
+                                               len(self.time_list[i]))
+                store.save("clarity", clarity_params, clarity)
+                store.save("notes", clarity_params, notes)
             self.clarity_list.append(clarity)
+            self.note_list.append(notes)
 
     def compute_rms(self):
         # compute an rms metric for track, but just over the areas
@@ -263,28 +653,28 @@ class SampleGroup():
         log("Estimating rms for active regions:")
         self.rms_list = []
         for i in range(len(self.intensity_list)):
+            store = self.features(self.name_list[i])
+            rms = store.load("rms", rms_params, mmap=False)
+            if rms is not None:
+                self.rms_list.append( float(rms) )
+                continue
             intensity = self.intensity_list[i]
-            # 3print("track:", i, len(clarity), len(intensity))
-            mean = np.mean(intensity)
-            std = np.std(intensity)
-            num = len(intensity)
-            five_perc = np.sort(intensity)[int(round(num*0.05))]
+            five_perc = low_percentile(intensity, rms_params["floor"])
             print("5%", five_perc)
             #threshold = std * 0.1
-            threshold = 4 * five_perc
-            sum = 0
-            count = 0
-            for j in range(len(intensity)):
-                if intensity[j] >= threshold:
-                    sum += intensity[j]*intensity[j]
-                    count += 1
-            if count > 0:
-                self.rms_list.append( math.sqrt(sum / count) )
+            threshold = rms_params["scale"] * five_perc
+            active = intensity[intensity >= threshold]
+            if len(active):
+                rms = math.sqrt(np.mean(active*active))
             else:
-                self.rms_list.append( 0 )
+                rms = 0
+            store.save("rms", rms_params, np.array(rms, dtype=float))
+            self.rms_list.append(rms)
         log("rms:", self.rms_list)
         
-    def compute_envelopes(self, hints={}):
+    def compute_envelopes(self, hints=None):
+        if hints is None:
+            hints = self.hints
         self.envelope_list = []
         self.suppress_list = []
         
@@ -303,8 +693,7 @@ class SampleGroup():
             max = np.max(intensity)
             print("mean:", mean, "std:", std, "min:", min)
             #print(np.sort(intensity).tolist())
-            num = len(intensity)
-            five_perc = np.sort(intensity)[int(round(num*0.05))]
+            five_perc = low_percentile(intensity, 0.05)
             print("5%", five_perc)
             #plt.figure()
             #plt.plot(np.sort(intensity))
@@ -313,90 +702,70 @@ class SampleGroup():
             #threshold = std * 0.1
             lower_threshold = five_perc
             upper_threshold = 2 * five_perc
+            starts, ends, active = hysteresis_runs(intensity,
+                                                   lower_threshold,
+                                                   upper_threshold)
+            ramp = int(round(0.1/dt))
+            # start of the current dead spot (0 if we start out dead)
             start = 0
-            end = 0
-            active = None
-            for j in range(len(intensity)):
-                if intensity[j] < lower_threshold:
-                    if active is None:
-                        # starting inactive
-                        env.append( [times[j], 0] )
-                    elif active:
-                        # just entered a dead spot
-                        #print(" active:", active, start, end)
-                        env.append( [times[j], 1] )
-                        start = j
-                    active = False
-                elif intensity[j] > upper_threshold:
-                    if active is None:
-                        # starting active
-                        env.append( [times[j], 1] )
-                    elif not active:
-                        # just entered a live spot
-                        commands.append([times[start], times[end]])
-                        # shape the dead spot env
-                        #print(" active:", active, start, end)
-                        if (end - start)*dt >= 0.2:
-                            p1 = start + int(round(0.1/dt))
-                            p2 = end - int(round(0.1/dt))
-                            env.append( [times[p1], 0] )
-                            env.append( [times[p2], 0] )
-                        else:
-                            mid = int((end + start)*0.5)
-                            env.append( [times[mid], 0] )
-                        env.append( [times[end], 1] )
-                        start = j
-                    active = True
-                end = j
-            #print(" active:", active, start, end)
-            if active:
+            for r in range(len(starts)):
+                j = starts[r]
+                if r == 0:
+                    # starting state
+                    env.append( [times[j], 1 if active[r] else 0] )
+                elif not active[r]:
+                    # just entered a dead spot
+                    env.append( [times[j], 1] )
+                    start = j
+                else:
+                    # just entered a live spot
+                    end = j - 1
+                    commands.append([times[start], times[end]])
+                    # shape the dead spot env
+                    if (end - start)*dt >= 0.2:
+                        env.append( [times[start + ramp], 0] )
+                        env.append( [times[end - ramp], 0] )
+                    else:
+                        mid = int((end + start)*0.5)
+                        env.append( [times[mid], 0] )
+                    env.append( [times[end], 1] )
+                    start = j
+            end = len(intensity) - 1
+            if len(active) and active[-1]:
                 env.append( [times[-1], 1] )
             else:
                 if (end - start)*dt >= 0.1:
-                    p1 = start + int(round(0.1/dt))
-                    env.append( [times[p1], 0] )
+                    env.append( [times[start + ramp], 0] )
                 env.append( [times[-1], 0] )
+            env = np.array(env, dtype=float).reshape(-1, 2)
+            commands = np.array(commands, dtype=float).reshape(-1, 2)
             #print(env)
             self.envelope_list.append(env)
             #print(commands)
             if name in hints and "no_suppress" in hints[name]:
                 log("no suppress in hints:", name)
-                self.suppress_list.append([])
+                self.suppress_list.append(np.zeros((0, 2)))
             else:
                 self.suppress_list.append(commands)
             
     def compute_margins(self):
-        # presumes onset envelopes and clarities have been computed
-        dt = self.time_list[0][1] - self.time_list[0][0]
-        #print("dt:", dt)
+        dt = analysis_hop / analysis_rate
         
         # find the start time of the the first clear note
-        first_note = [0] * len(self.clarity_list)
+        first_note = []
         lead_list = []
         for i in range(len(self.clarity_list)):
-            clarity = self.clarity_list[i]
-            accum = 0
-            for j in range(len(clarity)):
-                accum += clarity[j]
-                #print(self.time_list[i][j], accum)
-                if accum > 100000:
-                    first_note[i] = j
-                    lead_list.append(self.intensity_list[i][:j])
-                    break
+            j = claps.first_note(self.clarity_list[i])
+            first_note.append(0 if j is None else j)
+            if j is not None:
+                lead_list.append(self.intensity_list[i][:j])
         print("first notes:", first_note)
 
-        # ramp in/out
+        # ramp in/out (super short lead ins are left alone, sorry these
+        # will need to get fixed by hand probably)
         n = int(0.5 / dt)
-        for ll in lead_list:
-            print(len(ll), n)
-            if len(ll) > 2*n:
-                for i in range(n):
-                    ll[i] *= i/n
-                    ll[-(i+1)] *= i/n
-            else:
-                # skip super short lead in, sorry this one will need to
-                # get fixed by hand probably
-                pass
+        lead_list = [ claps.ramp(ll, n) for ll in lead_list ]
+        return lead_list
 
     def pretty_print_offset_array(self, offsets):
         print(offsets.shape)
@@ -405,83 +774,241 @@ class SampleGroup():
             print("%.3f " % offsets[i], end='')
         print()
             
-    def mutual_offset_solver(self, offset_matrix):
-        self.offset_list = []
-        done = False
-        count = 0
-        offsets = offset_matrix[0,:]
-        stds = np.zeros(offsets.shape[0])
-        self.pretty_print_offset_array(offsets)
-        while not done and count < 1000:
-            done = True
-            count += 1
-            offsets_ss = np.copy(offsets)
-            for i in range(offsets.shape[0]):
-                diff_array = offsets_ss - offset_matrix[i,:]
-                median = np.median(diff_array)
-                mean = np.mean(diff_array)
-                std = np.std(diff_array)
-                offsets[i] = median
-                stds[i] = std
-                print(diff_array)
-                print(median, mean, std)
-            print("count:", count)
-            self.pretty_print_offset_array(offsets)
-            # decide if we need to do another iteration
-            for i in range(offsets.shape[0]):
-                if abs(offsets[i] - offsets_ss[i]) > 0.0005:
-                    done = False
-        log("Fit deviations (indicator of fit quality):")
-        log(stds.tolist())
+    # find the track offsets that best agree with all the pairwise
+    # offsets, where offset_matrix[i,j] ~= offsets[j] - offsets[i].  Each
+    # pair is weighted by the confidence (peak sharpness) of its
+    # correlation, pairs with zero weight are treated as missing.  An
+    # L1 fit (iteratively reweighted least squares) keeps a few bad pairs
+    # from dragging the solution around.
+    def mutual_offset_solver(self, offset_matrix, weight_matrix=None):
+        num = offset_matrix.shape[0]
+        if weight_matrix is None:
+            weight_matrix = np.ones( (num, num) )
+        weights = np.clip(weight_matrix, 0, None) * (1 - np.eye(num))
+        valid = (weights > 0) | np.eye(num, dtype=bool)
+
+        # robust starting point: o[i] = median_j(o[j] - M[i,j])
+        offsets = np.where(valid[0,:], offset_matrix[0,:], 0.0)
+        for count in range(20):
+            diff = np.where(valid, offsets[np.newaxis,:] - offset_matrix,
+                            np.nan)
+            new_offsets = np.nanmedian(diff, axis=1)
+            done = np.max(np.abs(new_offsets - offsets)) < 0.0005
+            offsets = new_offsets
+            if done:
+                break
+
+        # weighted L1 refinement (IRLS), solving the normal equations of
+        # the weighted least squares problem each pass.  (L + 1) is the
+        # graph laplacian plus a term that pins the mean offset to zero.
+        eps = 0.5 * hop_length / sample_rate
+        offsets -= np.mean(offsets)
+        for count in range(100):
+            resid = offsets[np.newaxis,:] - offsets[:,np.newaxis] - offset_matrix
+            w = weights / np.maximum(np.abs(resid), eps)
+            laplacian = np.diag(np.sum(w, axis=1)) - w
+            rhs = -np.sum(w * offset_matrix, axis=1)
+            new_offsets = np.linalg.solve(laplacian + 1 + 1e-9*np.eye(num),
+                                          rhs)
+            done = np.max(np.abs(new_offsets - offsets)) < 1e-6
+            offsets = new_offsets
+            if done:
+                break
+        log("Offset solver iterations:", count + 1)
+
+        # per track fit residuals
+        resid = np.abs(offsets[np.newaxis,:] - offsets[:,np.newaxis] - offset_matrix)
+        resid = np.where(valid & (weights > 0), resid, np.nan)
+        self.residual_list = []
+        self.outlier_list = []
+        log("Fit residuals (median sec, indicator of fit quality):")
+        for i in range(num):
+            if np.any(~np.isnan(resid[i,:])):
+                r = float(np.nanmedian(resid[i,:]))
+            else:
+                r = 0.0
+            outlier = r > outlier_threshold
+            self.residual_list.append(r)
+            self.outlier_list.append(outlier)
+            if outlier:
+                flag = "  <-- OUTLIER, check this track"
+            else:
+                flag = ""
+            log("  %.3f %s%s" % (r, self.name_list[i], flag))
         # slide the solution by the median offset to keep it centered
         offsets -= np.median(offsets)
-        return offsets                
- 
-    def correlate_mutual(self, metric_list, plot=False):
-        # compute relative time offsets by best correlation
-        num = len(metric_list)
+        return offsets
+
+    # lag limit (in frames) and decimation factor for the correlation search
+    def search_params(self):
+        if self.max_offset is None:
+            max_lag = None
+        else:
+            dt = hop_length / sample_rate
+            max_lag = int(math.ceil(self.max_offset / dt))
+            log("Limiting alignment search to +/- %.1f sec" % self.max_offset)
+        if self.search == "coarse":
+            decimate = coarse_decimate
+        else:
+            decimate = 1
+        return max_lag, decimate
+
+    # content hashes of the source tracks
+    def track_hashes(self):
+        hashes = []
+        for file in self.name_list:
+            hashes.append( self.source_hash(file) )
+        return hashes
+
+    # metric_list: list of metric arrays, or the name of a feature (i.e.
+    # "clarity") which is then only computed if some pair isn't cached.
+    # cache_name: name of the metric if the pairwise results should be
+    # saved/reused in the group's cache (defaults to the feature name)
+    # fallback: retry weak pairs with the onset events of the whole
+    # tracks (turn this off when the metrics are only parts of the tracks)
+    def correlate_mutual(self, metric_list, plot=False, pairs=None,
+                         cache_name=None, fallback=True):
+        # compute relative time offsets by best correlation (of all
+        # pairs unless a subset of pairs is given)
+        metric_name = None
+        if isinstance(metric_list, str):
+            metric_name = metric_list
+            if cache_name is None:
+                cache_name = metric_name
+            num = len(self.name_list)
+        else:
+            num = len(metric_list)
         offset_matrix = np.zeros( (num, num) )
-        for i in range(0, num):
-            for j in range(i, num):
-                if i == j:
-                    offset_matrix[i, j] = 0
+        weight_matrix = np.zeros( (num, num) )
+        second_matrix = np.full( (num, num), np.nan )
+        fallback_matrix = np.zeros( (num, num), dtype=bool )
+        if pairs is None:
+            pairs = []
+            for i in range(0, num):
+                for j in range(i+1, num):
+                    pairs.append( (i, j) )
+        if plot:
+            # plotting needs the full correlation curves in this process
+            jobs = 1
+        else:
+            jobs = self.jobs
+        max_lag, decimate = self.search_params()
+
+        # fill in the pairs we already know from previous runs
+        cache = None
+        if cache_name is not None and not plot:
+            params = { "metric": cache_name, "hop_length": hop_length,
+                       "sample_rate": sample_rate,
+                       "analysis_rate": analysis_rate, "max_lag": max_lag,
+                       "decimate": decimate, "psr": "centered",
+                       "features": feature_params.get(cache_name),
+                       "fallback_psr": fallback_psr,
+                       "fallback_confidence": fallback_confidence }
+            if fallback:
+                params["fallback_features"] = onset_params
+            cache = PairCache(self.check_cache(), params)
+            hashes = self.track_hashes()
+            todo = []
+            for (i, j) in pairs:
+                result = cache.get(hashes[i], hashes[j])
+                if result is None:
+                    todo.append( (i, j) )
                 else:
-                    print(i, j, metric_list[i].shape, metric_list[j].shape)
-                    ycorr = np.correlate(metric_list[i],
-                                         metric_list[j],
-                                         mode='full')
-                    max_index = np.argmax(ycorr)
-                    print("max index:", max_index)
-                    if max_index > len(metric_list[j]):
-                        shift = max_index - len(metric_list[j])
-                        shift_time = self.time_list[i][shift]
-                        plot1 = metric_list[i]
-                        plot2 = np.concatenate([np.zeros(shift),
-                                                metric_list[j]])
-                        print(i, j, self.time_list[i][shift])
-                    elif max_index < len(metric_list[j]):
-                        shift = len(metric_list[j]) - 1 - max_index
-                        shift_time = -self.time_list[j][shift]
-                        plot1 = np.concatenate([np.zeros(shift),
-                                                metric_list[i]], axis=None)
-                        plot2 = metric_list[j]
-                        print(i, -self.time_list[j][shift])
-                    else:
-                        plot1 = metric_list[i]
-                        plot2 = metric_list[j]
-                        shift = 0
-                        shift_time = 0
-                        print(i, 0)
-                    offset_matrix[i, j] = shift_time
-                    offset_matrix[j, i] = -shift_time
-                if plot:
-                    plt.figure()
-                    plt.plot(ycorr)
-                    plt.figure()
-                    plt.plot(plot1, label=i)
-                    plt.plot(plot2, label=j)
-                    plt.legend()
-                    plt.show()
+                    (offset_matrix[i, j], weight_matrix[i, j], second,
+                     used) = result
+                    offset_matrix[j, i] = -offset_matrix[i, j]
+                    weight_matrix[j, i] = weight_matrix[i, j]
+                    fallback_matrix[i, j] = fallback_matrix[j, i] = used is not None
+                    if second is not None:
+                        second_matrix[i, j] = second
+                        second_matrix[j, i] = -second
+            log("Track pairs found in cache:", len(pairs) - len(todo))
+            pairs = todo
+
+        if metric_name is not None:
+            if len(pairs) or plot:
+                metric_list = getattr(self, metric_name + "_list")
+            else:
+                metric_list = []
+
+        log("Correlating", len(pairs), "track pairs, jobs:", jobs)
+        peaks = correlate.correlate_pairs(metric_list, pairs, jobs=jobs,
+                                          max_lag=max_lag, decimate=decimate)
+        if plot:
+            correlator = FFTCorrelator(metric_list)
+        dt = hop_length / sample_rate
+        for (i, j), (max_index, frac, psr, second) in zip(pairs, peaks):
+            print(i, j, metric_list[i].shape, metric_list[j].shape)
+            print("max index:", max_index)
+            if max_index > len(metric_list[j]):
+                shift = max_index - len(metric_list[j])
+                shift_time = self.time_list[i][shift]
+                plot1 = metric_list[i]
+                plot2 = np.concatenate([np.zeros(shift),
+                                        metric_list[j]])
+                print(i, j, self.time_list[i][shift])
+            elif max_index < len(metric_list[j]):
+                shift = len(metric_list[j]) - 1 - max_index
+                shift_time = -self.time_list[j][shift]
+                plot1 = np.concatenate([np.zeros(shift),
+                                        metric_list[i]], axis=None)
+                plot2 = metric_list[j]
+                print(i, -self.time_list[j][shift])
+            else:
+                plot1 = metric_list[i]
+                plot2 = metric_list[j]
+                shift = 0
+                shift_time = 0
+                print(i, 0)
+            # sub-hop peak position
+            shift_time += frac * dt
+            # runner up alignment, relative to the best one
+            if second is not None:
+                second_time = shift_time + (second - max_index) * dt
+            else:
+                second_time = np.nan
+            if fallback and psr < fallback_psr:
+                # weak correlation peak, use the onset events instead if
+                # they agree clearly on an offset.  (The event confidence
+                # is a histogram peak ratio, not comparable to the psr, so
+                # it has its own threshold and the pair keeps its psr as
+                # the solver weight.)
+                event_time, confidence = self.event_pair(i, j)
+                if confidence >= fallback_confidence:
+                    log("  low confidence pair:", i, j, "psr: %.1f" % psr,
+                        "using onset events, confidence: %.1f" % confidence)
+                    shift_time = event_time
+                    second_time = np.nan
+                    fallback_matrix[i, j] = fallback_matrix[j, i] = True
+            offset_matrix[i, j] = shift_time
+            offset_matrix[j, i] = -shift_time
+            # keep a (tiny) weight so a computed pair is never treated as
+            # missing by the solver
+            weight_matrix[i, j] = max(psr, 0.01)
+            weight_matrix[j, i] = max(psr, 0.01)
+            second_matrix[i, j] = second_time
+            second_matrix[j, i] = -second_time
+            if cache is not None:
+                if np.isnan(second_time):
+                    second_time = None
+                else:
+                    second_time = float(second_time)
+                if fallback_matrix[i, j]:
+                    used = "onset"
+                else:
+                    used = None
+                cache.put(hashes[i], hashes[j], float(shift_time),
+                          float(weight_matrix[i, j]), second_time, used)
+            if plot:
+                plt.figure()
+                plt.plot(correlator.correlate(i, j))
+                plt.figure()
+                plt.plot(plot1, label=i)
+                plt.plot(plot2, label=j)
+                plt.legend()
+                plt.show()
+        if cache is not None:
+            cache.save()
         print("offset_matrix:\n", offset_matrix)
 
         # if False:
@@ -494,9 +1021,95 @@ class SampleGroup():
         #         print(median, np.mean(diff_array), np.std(diff_array))
         #         self.offset_list.append(median)
         
-        self.offset_list = self.mutual_offset_solver(offset_matrix).tolist()
+        self.offset_list = self.mutual_offset_solver(offset_matrix, weight_matrix).tolist()
         log("Track time offsets (sec):", self.offset_list)
+        self.pair_stats(offset_matrix, weight_matrix, second_matrix,
+                        fallback_matrix)
+
+    # per track confidence for the alignment report: median correlation
+    # psr of its pairs (the pair weights), how far (median sec) the
+    # second best alignment of its pairs would move it, and how many of
+    # its pairs used the onset event fallback
+    def pair_stats(self, offset_matrix, psr_matrix, second_matrix,
+                   fallback_matrix):
+        pair = (psr_matrix > 0)
+        self.psr_list = []
+        self.second_list = []
+        self.fallback_list = []
+        for i in range(offset_matrix.shape[0]):
+            if np.any(pair[i,:]):
+                self.psr_list.append(float(np.median(psr_matrix[i, pair[i,:]])))
+            else:
+                self.psr_list.append(None)
+            second = offset_matrix[i, pair[i,:]] - second_matrix[i, pair[i,:]]
+            second = second[~np.isnan(second)]
+            if len(second):
+                self.second_list.append(float(np.median(second)))
+            else:
+                self.second_list.append(None)
+            self.fallback_list.append(int(np.count_nonzero(fallback_matrix[i, pair[i,:]])))
         
+    # pick the k tracks with the clearest notes relative to their
+    # loudness (clarity energy per unit rms) to serve as anchors.  The
+    # anchors are remembered in the group cache (by track content hash)
+    # and reused while those tracks are all unchanged, so a re-sync whose
+    # pairs are all cached never needs the clarities just to pick them.
+    # The list is also keyed by the feature parameters the scores come
+    # from, changing those picks the anchors again.
+    def select_anchors(self, k):
+        hashes = self.track_hashes()
+        params = { "clarity": clarity_params, "rms": rms_params }
+        anchor_file = os.path.join(self.check_cache(), "anchors.json")
+        if os.path.exists(anchor_file):
+            try:
+                with open(anchor_file, "r") as fp:
+                    previous = json.load(fp)
+                if previous["k"] == k \
+                   and previous.get("features") == params and \
+                   all(h in hashes for h in previous["anchors"]):
+                    anchors = sorted([ hashes.index(h) for h in previous["anchors"] ])
+                    log("Anchor tracks (from cache):",
+                        [ self.name_list[i] for i in anchors ])
+                    return anchors
+            except Exception as e:
+                log("NOTICE: ignoring unreadable anchor list:", anchor_file)
+                log(str(e))
+        scores = []
+        for i in range(len(self.clarity_list)):
+            if self.rms_list[i] > 0 and len(self.clarity_list[i]):
+                scores.append( np.mean(self.clarity_list[i]) / self.rms_list[i] )
+            else:
+                scores.append( 0 )
+        anchors = sorted(np.argsort(scores)[::-1][:k].tolist())
+        log("Anchor tracks:", [ self.name_list[i] for i in anchors ])
+        with open(anchor_file, "w") as fp:
+            json.dump({ "k": k, "features": params,
+                        "anchors": [ hashes[i] for i in anchors ] },
+                      fp, indent=4)
+        return anchors
+
+    # O(N*k) alternative to correlate_mutual() for very large groups:
+    # the anchors are correlated with each other and every other track is
+    # correlated only against the anchors, then all of these pairs are
+    # solved jointly.
+    def correlate_anchors(self, metric_list, k=8, plot=False,
+                          cache_name=None):
+        num = len(self.name_list)
+        if num <= k + 1:
+            # nothing to save, just do them all
+            self.correlate_mutual(metric_list, plot=plot,
+                                  cache_name=cache_name)
+            return
+        anchors = self.select_anchors(k)
+        pairs = []
+        for i in range(num):
+            for j in anchors:
+                if i < j or (i > j and not i in anchors):
+                    pairs.append( (min(i, j), max(i, j)) )
+        pairs = sorted(pairs)
+        self.correlate_mutual(metric_list, plot=plot, pairs=pairs,
+                              cache_name=cache_name)
+
     def mydiff(self, a, b):
         an = a.shape[0]
         bn = b.shape[0]
@@ -515,14 +1128,15 @@ class SampleGroup():
         # compute relative time offsets by best correlation
         num = len(metric_list)
         self.offset_list = [0] * num
+        self.psr_list = [None] * num
+        self.second_list = [None] * num
+        max_lag, decimate = self.search_params()
+        correlator = FFTCorrelator(metric_list, max_lag=max_lag,
+                                   decimate=decimate)
         for i in range(0, num):
             print(ref_index, i, metric_list[ref_index].shape, metric_list[i].shape)
-            ycorr = np.correlate(metric_list[ref_index],
-                                 metric_list[i],
-                                 mode='full')
             #ycorr = self.mydiff(metric_list[ref_index], metric_list[i])
-            max_val = np.amax(ycorr)
-            max_index = np.argmax(ycorr)
+            max_index, frac, psr, second = correlator.best_peak(ref_index, i)
             print("max index:", max_index)
             if max_index > len(metric_list[i]):
                 shift = max_index - len(metric_list[i])
@@ -544,10 +1158,16 @@ class SampleGroup():
                 shift = 0
                 shift_time = 0
                 print(ref_index, 0)
+            # sub-hop peak position
+            shift_time += frac * hop_length / sample_rate
             self.offset_list[i] = shift_time
+            if i != ref_index:
+                self.psr_list[i] = psr
+                if second is not None:
+                    self.second_list[i] = (second - max_index) * hop_length / sample_rate
             if plot:
                 plt.figure()
-                plt.plot(ycorr)
+                plt.plot(correlator.correlate(ref_index, i))
                 plt.figure()
                 plt.plot(plot1, label=ref_index)
                 plt.plot(plot2, label=i)
@@ -555,124 +1175,319 @@ class SampleGroup():
                 plt.show()
         print("offset_list:\n", self.offset_list)
 
-    # sync by claps
-    def sync_by_claps(self, plot=False):
-        # presumes onset envelopes and clarities have been computed
+    # refine the (hop quantized) offset_list to sample level accuracy
+    # by correlating a few short segments of the filtered raw audio of
+    # each track against the reference (loudest) track, searching only a
+    # small window of lags around the current offset.  (Lags are in
+    # analysis rate samples, interpolated to a fraction of a sample.)  A
+    # track whose best lag lands on the edge of the window keeps its
+    # coarse offset.
+    def refine_offsets(self, window=2*analysis_hop, seg_sec=5, segments=3):
+        log("Refining track offsets to sample resolution...")
+        if len(self.offset_list) < 2:
+            return
+        ref = int(np.argmax(self.rms_list))
+        seg_frames = int(seg_sec * analysis_rate / analysis_hop)
+        offsets = np.array(self.offset_list, dtype=float)
+        for i in range(len(self.offset_list)):
+            if i == ref:
+                continue
+            # pick the loudest stretches of this track
+            intensity = self.intensity_list[i]
+            starts = []
+            if len(intensity) <= seg_frames:
+                starts.append(0)
+            else:
+                energy = np.convolve(intensity, np.ones(seg_frames),
+                                     mode='valid')
+                for k in range(segments):
+                    best = int(np.argmax(energy))
+                    if energy[best] <= 0 and len(starts):
+                        break
+                    starts.append(best * analysis_hop)
+                    energy[max(best-seg_frames, 0):best+seg_frames] = -1
+            lag0 = int(round((offsets[i] - offsets[ref]) * analysis_rate))
+            lag, inside = correlate.refine_lag(self.raw_list[ref],
+                                               self.raw_list[i],
+                                               lag0, window, starts,
+                                               seg_frames * analysis_hop)
+            if not inside:
+                # the best lag is outside the window, don't trust it
+                log("  NOTICE: refined offset at the edge of the search window, keeping the coarse offset:",
+                    self.name_list[i])
+                continue
+            offsets[i] = offsets[ref] + lag / analysis_rate
+            print(" ", self.name_list[i], "adjust (ms): %.3f" % ((lag - lag0) * 1000 / analysis_rate))
+        self.offset_list = offsets.tolist()
+        log("Refined track time offsets (sec):", self.offset_list)
 
-        dt = self.time_list[0][1] - self.time_list[0][0]
+    # look for tempo drift of each track against the rest of the group
+    # (see drift.py), fills in drift_list with a piecewise offset map for
+    # each track (empty for tracks that don't drift)
+    def detect_drift(self):
+        log("Checking tracks for tempo drift...")
+        dt = analysis_hop / analysis_rate
+        self.drift_list = drift.detect_drift(self.clarity_list,
+                                             self.offset_list, dt,
+                                             **drift_params)
+        for i, steps in enumerate(self.drift_list):
+            if len(steps):
+                log("  NOTICE: drift correction will splice:",
+                    self.name_list[i])
+                for (t, d) in steps:
+                    log("    from %.2f sec: %+.3f sec" % (t, d))
+
+    # alignment quality of each track (for results/alignment.json): its
+    # offset, peak to sidelobe ratio (median over its pairs), second best
+    # lag (sec, where the runner up correlation peak would move the track
+    # relative to its offset), solver fit residual, and a pass flag that
+    # is false for fit outliers and weak correlation peaks.  Anything
+    # the sync method didn't produce is null.  Tracks with pairs aligned
+    # by the onset event fallback are marked with "fallback": "onset" and
+    # the number of those pairs (their psr is still the correlation psr.)
+    def alignment_report(self):
+        tracks = {}
+        for i, name in enumerate(self.name_list):
+            psr = list_value(self.psr_list, i)
+            residual = list_value(self.residual_list, i)
+            ok = True
+            if psr is not None and psr < report_psr:
+                ok = False
+            if residual is not None and residual > outlier_threshold:
+                ok = False
+            entry = { "offset": list_value(self.offset_list, i),
+                      "psr": psr,
+                      "second_best_lag": list_value(self.second_list, i),
+                      "residual": residual,
+                      "pass": ok }
+            if i < len(self.fallback_list) and self.fallback_list[i]:
+                entry["fallback"] = "onset"
+                entry["fallback_pairs"] = self.fallback_list[i]
+            if i < len(self.drift_list) and len(self.drift_list[i]):
+                entry["drift"] = self.drift_list[i]
+            tracks[os.path.basename(name)] = entry
+            if not ok:
+                log("  suspect alignment:", name)
+        return tracks
+
+    # the drift maps are kept in the group cache for the video renderer
+    def save_drift(self):
+        drift_map = {}
+        for i, steps in enumerate(self.drift_list):
+            if len(steps):
+                drift_map[os.path.basename(self.name_list[i])] = steps
+        with open(os.path.join(self.check_cache(), "drift.json"), "w") as fp:
+            json.dump(drift_map, fp, indent=4)
+
+    # strongest onset events (times in sec) of each track
+    def compute_events(self):
+        dt = analysis_hop / analysis_rate
+        self.event_list = []
+        for onset in self.onset_list:
+            self.event_list.append( events.onset_events(onset, dt) )
+
+    # offset and confidence of a track pair from their onset events
+    def event_pair(self, i, j):
+        dt = analysis_hop / analysis_rate
+        return events.event_offset(self.event_list[i], self.event_list[j],
+                                   dt, self.max_offset)
+
+    # sync by the strongest onset events of each track (see events.py):
+    # cheap, so it suits quick previews and very large groups
+    def sync_by_onsets(self):
+        num = len(self.name_list)
+        offset_matrix = np.zeros( (num, num) )
+        weight_matrix = np.zeros( (num, num) )
+        for i in range(num):
+            for j in range(i+1, num):
+                offset, confidence = self.event_pair(i, j)
+                offset_matrix[i, j] = offset
+                offset_matrix[j, i] = -offset
+                weight_matrix[i, j] = max(confidence, 0.01)
+                weight_matrix[j, i] = max(confidence, 0.01)
+        print("offset_matrix:\n", offset_matrix)
+        self.offset_list = self.mutual_offset_solver(offset_matrix, weight_matrix).tolist()
+        log("Track time offsets (sec):", self.offset_list)
+
+    # sync by lead in claps (see claps.py): find each track's first clear
+    # note, then the clap (or four clap count in) before it.  If a track
+    # has no clap that can be found, fall back to correlating the
+    # smoothed lead in intensities of all the tracks.
+    def sync_by_claps(self, plot=False):
+        dt = analysis_hop / analysis_rate
         print("dt:", dt)
         
-        # find the start time of the the first clear note
-        first_note = [0] * len(self.clarity_list)
+        # lead in of each track: up to 1 sec before its first clear note
+        trim = int(round(1.0 / dt))
         lead_list = []
         for i in range(len(self.clarity_list)):
             clarity = self.clarity_list[i]
-            mean = np.mean(self.clarity_list[i])
-            std = np.std(self.clarity_list[i])
-            accum = 0
-            for j in range(len(clarity)):
-                if clarity[j] > std * 0.25:
-                    accum += clarity[j]
-                    #print(self.time_list[i][j], accum)
-                if accum > 100000:
-                    first_note[i] = j
-                    trim = int(round((1.0/dt)))
-                    lead_list.append(self.intensity_list[i][:j-trim])
-                    break
-        print("first notes:", first_note)
+            j = claps.first_note(clarity, threshold=np.std(clarity) * 0.25)
+            if j is None:
+                j = len(clarity)
+            lead_list.append(max(j - trim, 0))
+        print("lead in frames:", lead_list)
 
-        # ramp in/out
+        clap_list = []
+        for i, lead in enumerate(lead_list):
+            clap_list.append(claps.find_clap(self.onset_list[i], dt, lead * dt))
+        counts = [ count for (t, strength, count) in clap_list ]
+        if 0 in counts:
+            for i, (t, strength, count) in enumerate(clap_list):
+                if not count:
+                    log("  no lead in clap found in:", self.name_list[i])
+            log("Falling back to correlating the lead in intensities")
+            self.correlate_leads(lead_list, plot=plot)
+            return
+        if min(counts) < max(counts):
+            # some tracks count in, some don't: use the strongest single
+            # clap everywhere rather than mixing up the claps
+            clap_list = [ claps.find_clap(self.onset_list[i], dt,
+                                          lead * dt, counts=(1,))
+                          for i, lead in enumerate(lead_list) ]
+        for i, (t, strength, count) in enumerate(clap_list):
+            log("  clap at %.3f sec (%d clap pattern):" % (t, count),
+                self.name_list[i])
+
+        # line up the claps on the timeline (timeline = track time + offset)
+        offsets = -np.array([ t for (t, strength, count) in clap_list ])
+        self.offset_list = (offsets - np.mean(offsets)).tolist()
+        log("Track time offsets (sec):", self.offset_list)
+
+        if plot:
+            for i, (t, strength, count) in enumerate(clap_list):
+                lead = lead_list[i]
+                times = np.arange(lead) * dt + self.offset_list[i]
+                plt.plot(times, self.onset_list[i][:lead],
+                         label=os.path.basename(self.name_list[i]))
+            plt.axvline(x=-np.mean(offsets), color='k')
+            plt.legend()
+            plt.show()
+
+    # correlate the (ramped and smoothed) lead in intensities of the
+    # tracks, lead_list is the lead in length (frames) of each track.
+    # Tracks with a lead in too short to ramp in/out are left out of the
+    # correlation (sorry, these will need to get aligned by hand.)
+    def correlate_leads(self, lead_list, plot=False):
+        dt = analysis_hop / analysis_rate
         n = int(0.5 / dt)
-        for ll in lead_list:
-            print(len(ll), n)
-            if len(ll) > 2*n:
-                for i in range(n):
-                    ll[i] *= i/n
-                    ll[-(i+1)] *= i/n
+        box_pts = int(0.2 / dt)
+        box = np.ones(box_pts) / box_pts
+        metric_list = []
+        usable = []
+        for i, lead in enumerate(lead_list):
+            if lead > 2*n:
+                # ramp in/out, then smooth (spread out peaks so better
+                # chance of overlapping)
+                ll = claps.ramp(self.intensity_list[i][:lead], n)
+                metric_list.append(np.convolve(ll, box, mode='same'))
+                usable.append(i)
             else:
-                # skip super short lead in, sorry this track will need
-                # to get aligned by hand probably
-                pass
-
-        # smooth (spread out peaks so better chance of overlapping
-        for i in range(len(lead_list)):
-            box_pts = int(0.2/dt)
-            box = np.ones(box_pts)/box_pts
-            lead_list[i] = np.convolve(lead_list[i], box, mode='same')
-            
-        self.correlate_mutual(lead_list, plot=plot)
+                log("  lead in too short to align, needs to be aligned by hand:",
+                    self.name_list[i])
+                # placeholder (never correlated, see pairs)
+                metric_list.append(np.zeros(1))
+        pairs = []
+        for a in range(len(usable)):
+            for b in range(a+1, len(usable)):
+                pairs.append( (usable[a], usable[b]) )
+        self.correlate_mutual(metric_list, plot=plot, pairs=pairs,
+                              fallback=False)
 
     def clean_noise(self, clean=0.2, reverb=0):
         cache_dir = self.check_cache()
+        manifest = self.get_manifest()
         
-        for i, sample in enumerate(self.sample_list):
-            fullname = os.path.join(self.path, self.name_list[i])
+        for i, raw in enumerate(self.sample_list):
             name = os.path.basename(self.name_list[i])
-            basename, ext = os.path.splitext(name)
-            canon_name = os.path.join(self.path, "cache",
-                                      basename + "-canon.mp3")
-            noise_name = os.path.join(self.path, "cache",
-                                      basename + "-noise.mp3")
-            noiseprof_name = os.path.join(self.path, "cache",
-                                         basename + ".noiseprof")
-            clean_name = os.path.join(self.path, "cache",
-                                      basename + "-clean.mp3")
+            source = self.source_hash(self.name_list[i])
+            # the noise sample depends on the suppression zones, the
+            # cleaned audio also on the cleaning parameters
+            noise_params = { "canon": canon_params,
+                             "suppress": np.asarray(self.suppress_list[i]).tolist() }
+            clean_params = { "noise": noise_params, "clean": clean,
+                             "reverb": reverb }
+            noise_name = self.cache_file(name, "-noise.wav")
+            noiseprof_name = self.cache_file(name, ".noiseprof")
+            clean_name = self.cache_file(name, "-clean.npy")
             log("Generating noise profile for:", name)
-            if not self.is_newer(noise_name, canon_name):
-                new_sample = AudioSegment.empty()
+            noise_key = os.path.basename(noise_name)
+            if not manifest.is_current(noise_key, source, noise_params,
+                                       noise_name):
+                segments = []
                 commands = self.suppress_list[i]
                 if len(commands):
                     #print("commands:", commands)
                     blend = 100     # ms
-                    seg = None
-                    start = 0
                     for cmd in commands:
                         print("command:", cmd)
                         (t0, t1) = cmd
                         ms0 = int(round(t0*1000))
                         ms1 = int(round(t1*1000))
-                        print("  start:", start, "range:", ms0, ms1)
                         if (ms1 - ms0) < 2*blend:
                             # too short to deal with
                             continue
                         print("noise:", ms0, ms1)
-                        noise = sample[ms0:ms1]
-                        new_sample += noise
-                        # if new_sample is None:
-                        #     print("first sample:", len(noise))
-                        #     new_sample = noise
-                        # else:
-                        #     print("append sample:", len(noise), len(new_sample))
-                        #     new_sample.append(noise, crossfade=blend)
+                        n0 = int(ms0 * sample_rate / 1000)
+                        n1 = int(ms1 * sample_rate / 1000)
+                        segments.append( raw[n0:n1] )
                 else:
                     log("  no suppression commands for:", name)
-                if len(new_sample) > 0:
+                if len(segments):
                     # generate noise sample
-                    print("export noise sample:", len(new_sample))
-                    new_sample.export(noise_name, format="mp3")
+                    noise = np.concatenate(segments)
+                    print("export noise sample:", len(noise))
+                    wavfile.write(noise_name, sample_rate, noise)
+                    manifest.update(noise_key, source, noise_params)
+                elif os.path.exists(noise_name):
+                    # stale from a previous run
+                    os.unlink(noise_name)
             if os.path.exists(noise_name):
-                if not self.is_newer(noiseprof_name, noise_name):
+                noiseprof_key = os.path.basename(noiseprof_name)
+                if not manifest.is_current(noiseprof_key, source,
+                                           noise_params, noiseprof_name):
                     # generate noise profile
                     command = [ "sox", noise_name, "-n", "noiseprof",
                                 noiseprof_name ]
                     log("command:", command)
                     result = call(command)
                     log("sox result code:", result)
+                    if result == 0:
+                        manifest.update(noiseprof_key, source, noise_params)
+            elif os.path.exists(noiseprof_name):
+                # stale from a previous run
+                os.unlink(noiseprof_name)
             if os.path.exists(noiseprof_name):
-                # generate cleaned up version of audio
-                if not self.is_newer(clean_name, noiseprof_name):
-                    command = [ "sox", canon_name, clean_name, "noisered",
-                                noiseprof_name, "%0.2f" % clean ]
+                # generate cleaned up version of audio (piping the
+                # canonical audio through sox as raw pcm)
+                clean_key = os.path.basename(clean_name)
+                if not manifest.is_current(clean_key, source, clean_params,
+                                           clean_name):
+                    pcm = [ "-t", "raw", "-r", str(sample_rate),
+                            "-e", "signed", "-b", "16",
+                            "-c", str(raw.shape[1]) ]
+                    command = [ "sox" ] + pcm + [ "-" ] + pcm + [ "-",
+                                "noisered", noiseprof_name, "%0.2f" % clean ]
                     if reverb > 0:
                         command += [ "reverb", "%d" % reverb, "50", "75" ]
                     log("command:", command)
-                    result = call(command)
-                    log("sox result code:", result)
+                    # subprocess wants bytes, not a (memory mapped) array
+                    result = subprocess.run(command,
+                                            input=np.ascontiguousarray(raw).tobytes(),
+                                            stdout=subprocess.PIPE)
+                    log("sox result code:", result.returncode)
+                    if result.returncode == 0:
+                        cleaned = np.frombuffer(result.stdout, dtype=np.int16)
+                        np.save(clean_name, cleaned.reshape(-1, raw.shape[1]))
+                        manifest.update(clean_key, source, clean_params)
                 else:
-                    print(clean_name, "is newer than", noise_name)
+                    print(clean_name, "is current")
             else:
-                log("No noise profile, using original sample as the cleaned version:", clean_name)
-                sample.export(clean_name, format="mp3")
+                log("No noise profile, using original sample as the cleaned version:", name)
+                if os.path.exists(clean_name):
+                    # stale from a previous run
+                    os.unlink(clean_name)
+        manifest.save()
                 
     # visualize audio streams (using librosa functions)
     def gen_plots(self, sync_offsets=None):
@@ -684,8 +1499,8 @@ class SampleGroup():
             if sync_offsets is None:
                 trimval = 0
             else:
-                trimval = int(round(sync_offsets[i] * sample_rate / 1000))
-            librosa.display.waveplot(np.array(self.raw_list[i][trimval:]).astype('float'), sr=sample_rate, ax=ax[i])
+                trimval = int(round(sync_offsets[i] * analysis_rate / 1000))
+            librosa.display.waveplot(self.raw_list[i][trimval:], sr=analysis_rate, ax=ax[i])
             ax[i].set(title=self.name_list[i])
             ax[i].label_outer()
             if ( len(self.beat_list) ):
@@ -724,11 +1539,12 @@ class SampleGroup():
                 if sync_offsets is None:
                     trimval = 0
                 else:
-                    trimval = int(round(sync_offsets[i] * sample_rate / 1000))
+                    trimval = int(round(sync_offsets[i] * analysis_rate / 1000))
                 img = librosa.display.specshow(self.chroma_list[i],
                                                x_axis='time',
                                                y_axis='chroma',
-                                               hop_length=int(hop_length*0.5), ax=ax[i])
+                                               sr=analysis_rate,
+                                               hop_length=analysis_hop, ax=ax[i])
                 ax[i].set(title='Chroma Representation of ' + self.name_list[i])
             fig.colorbar(img, ax=ax)
 
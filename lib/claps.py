@@ -0,0 +1,104 @@
+# lead in clap detection
+
+# Singers are often asked to clap once (or count in with four claps)
+# before they start singing, which gives a sharp, easy to find sync
+# point.  The lead in of a track is everything before its first clear
+# note (found with a running sum of clarity), the claps are transient
+# peaks of the onset envelope in the lead in, and a count in is picked
+# out of those peaks by its evenly spaced inter-onset intervals.
+# Everything here works on whole arrays, a track takes milliseconds.
+
+import numpy as np
+from scipy import signal
+
+# index of the first frame where the running sum of clarity passes
+# limit (counting only frames above threshold if one is given), or None
+# if it never does
+def first_note(clarity, limit=100000, threshold=None):
+    clarity = np.asarray(clarity, dtype=float)
+    if threshold is not None:
+        clarity = np.where(clarity > threshold, clarity, 0)
+    accum = np.cumsum(clarity)
+    if not len(accum) or accum[-1] <= limit:
+        return None
+    return int(np.argmax(accum > limit))
+
+# copy of x faded in over the first n frames and out over the last n
+# (left as is if x is too short for that)
+def ramp(x, n):
+    x = np.array(x, dtype=float)
+    if n > 0 and len(x) > 2*n:
+        r = np.arange(n) / n
+        x[:n] *= r
+        x[-n:] *= r[::-1]
+    return x
+
+# transient peaks of an onset envelope: frames at least min_sep sec
+# apart that stand out from the typical (median) level of the envelope
+# by min_strength median absolute deviations.  Returns the peak times
+# (sec) and strengths.
+def transients(onset, dt, min_sep=0.15, min_strength=8):
+    onset = np.asarray(onset, dtype=float)
+    if len(onset) < 3:
+        return np.zeros(0), np.zeros(0)
+    median = np.median(onset)
+    mad = np.median(np.abs(onset - median))
+    if mad <= 0:
+        mad = np.std(onset)
+    if mad <= 0:
+        return np.zeros(0), np.zeros(0)
+    strength = (onset - median) / mad
+    distance = max(1, int(round(min_sep / dt)))
+    peaks, props = signal.find_peaks(strength, height=min_strength,
+                                     prominence=min_strength,
+                                     distance=distance)
+    return peaks * dt, props["peak_heights"]
+
+# find a pattern of count evenly spaced claps among the transients.
+# Every pair of transients (with a plausible spacing) is tried as the
+# first two claps and the rest of the pattern is looked up where it
+# should be, the pattern with the strongest claps wins.  Returns the time
+# of the first clap (sec) and the pattern strength (sum of the clap
+# strengths), or (None, 0) if no pattern fits.
+def match_claps(times, strengths, count=4, min_interval=0.25,
+                max_interval=1.5, tolerance=0.08):
+    times = np.asarray(times, dtype=float)
+    strengths = np.asarray(strengths, dtype=float)
+    if len(times) < count or count < 1:
+        return None, 0.0
+    if count == 1:
+        best = int(np.argmax(strengths))
+        return float(times[best]), float(strengths[best])
+    (a, b) = np.triu_indices(len(times), 1)
+    interval = times[b] - times[a]
+    keep = (interval >= min_interval) & (interval <= max_interval)
+    (a, b, interval) = (a[keep], b[keep], interval[keep])
+    if not len(a):
+        return None, 0.0
+    # expected time of every clap of every candidate pattern, matched to
+    # the nearest transient
+    k = np.arange(count)
+    expected = times[a][:,np.newaxis] + interval[:,np.newaxis] * k
+    right = np.clip(np.searchsorted(times, expected), 1, len(times) - 1)
+    left = right - 1
+    nearest = np.where(np.abs(times[left] - expected)
+                       <= np.abs(times[right] - expected), left, right)
+    error = np.abs(times[nearest] - expected)
+    fits = np.all(error <= tolerance, axis=1)
+    if not np.any(fits):
+        return None, 0.0
+    score = np.where(fits, np.sum(strengths[nearest], axis=1), 0)
+    best = int(np.argmax(score))
+    return float(times[a[best]]), float(score[best])
+
+# time (sec), strength, and pattern size of the sync clap in a track:
+# the first clap of the first pattern in counts found in the lead in (the
+# first lead_sec seconds) of the onset envelope, or (None, 0, 0)
+def find_clap(onset, dt, lead_sec, counts=(4, 1)):
+    lead = onset[:max(0, int(lead_sec / dt))]
+    times, strengths = transients(lead, dt)
+    for count in counts:
+        t, strength = match_claps(times, strengths, count)
+        if t is not None:
+            return t, strength, count
+    return None, 0.0, 0
@@ -0,0 +1,327 @@
+# fft based cross correlation engine for aligning tracks
+
+# np.correlate(mode='full') is O(n^2) per pair and a mutual sync
+# needs O(N^2) pairs.  Here each metric array is padded once to a
+# common fft length, its spectrum is computed once and cached, and
+# every pairwise correlation is then just a spectrum product and an
+# inverse fft.
+
+import math
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from scipy import fft
+from scipy import signal
+
+# block average a metric array down by an integer factor (for the
+# coarse pass of a coarse to fine search)
+def decimate_metric(metric, factor):
+    metric = np.asarray(metric, dtype=float)
+    blocks = int(math.ceil(len(metric) / factor))
+    padded = np.zeros(blocks * factor)
+    padded[:len(metric)] = metric
+    return padded.reshape(blocks, factor).mean(axis=1)
+
+# x[lo:hi] but zero filled where the range runs off either end of x
+def padded_slice(x, lo, hi):
+    result = np.zeros(hi - lo)
+    start = max(lo, 0)
+    end = min(hi, len(x))
+    if end > start:
+        result[start-lo:end-lo] = x[start:end]
+    return result
+
+# fit a parabola through a peak and its two neighbors, return the
+# fractional position of the true peak relative to index (-0.5 to 0.5)
+def parabolic_offset(y, index):
+    if index <= 0 or index >= len(y) - 1:
+        return 0.0
+    a = y[index-1]
+    b = y[index]
+    c = y[index+1]
+    denom = a - 2*b + c
+    if denom >= 0:
+        # flat or not a peak
+        return 0.0
+    return float(np.clip(0.5 * (a - c) / denom, -0.5, 0.5))
+
+# refine the lag (in samples) between two raw signals to sub-sample
+# accuracy.  Only lags within +/- window of lag0 are searched, and only
+# using a few short segments of b (starting at the given indices), so
+# this is cheap compared to a correlation over the whole track.
+# Returns the refined lag and a flag that is false if the best match
+# landed at the edge of the search window.  (Only the segments are
+# converted to float, not the whole signals.)
+def refine_lag(a, b, lag0, window, starts, seg_len):
+    total = np.zeros(2*window + 1)
+    for start in starts:
+        seg = np.asarray(b[start:start+seg_len], dtype=float)
+        if len(seg) == 0:
+            continue
+        lo = start + lag0 - window
+        chunk = padded_slice(a, lo, lo + len(seg) + 2*window)
+        total += signal.correlate(chunk, seg, mode='valid', method='fft')
+    index = int(np.argmax(total))
+    inside = index > 0 and index < 2*window
+    return lag0 - window + index + parabolic_offset(total, index), inside
+
+# peak to sidelobe ratio: height of the peak above the mean of the rest
+# of the correlation curve (ignoring +/- exclude points around the
+# peak) in units of the standard deviation of the rest.  A sharp,
+# unambiguous alignment scores high, a flat or noisy curve scores near 0.
+def peak_ratio(ycorr, index, exclude):
+    mask = np.ones(len(ycorr), dtype=bool)
+    mask[max(index-exclude, 0):index+exclude+1] = False
+    if np.count_nonzero(mask) < 2:
+        return 0.0
+    side = ycorr[mask]
+    std = np.std(side)
+    if std <= 0:
+        return 0.0
+    return float((ycorr[index] - np.mean(side)) / std)
+
+# index of the second best alignment: the highest local peak of the
+# correlation curve outside the main lobe (+/- exclude points) of the
+# peak at index, or None if there isn't one
+def second_peak(ycorr, index, exclude):
+    peaks, props = signal.find_peaks(ycorr, height=-np.inf)
+    outside = np.abs(peaks - index) > exclude
+    if not np.any(outside):
+        return None
+    best = np.argmax(props["peak_heights"][outside])
+    return int(peaks[outside][best])
+
+class FFTCorrelator():
+    # max_lag: optional limit (in frames) on the lags searched for the
+    # best alignment.
+    # decimate: if > 1, find a coarse lag on metric arrays decimated by
+    # this factor, then refine only inside a small window of lags at
+    # full resolution.
+    # exclude: half width (in frames) of the main lobe of the peak, left
+    # out of the sidelobe statistics for the peak to sidelobe ratio.
+    def __init__(self, metric_list, max_lag=None, decimate=1, exclude=16):
+        self.metric_list = metric_list
+        self.max_lag = max_lag
+        self.decimate = decimate
+        self.exclude = exclude
+        maxlen = 1
+        for metric in metric_list:
+            if len(metric) > maxlen:
+                maxlen = len(metric)
+        # pad enough that no pair of tracks wraps around in the
+        # circular correlation
+        self.nfft = fft.next_fast_len(2*maxlen - 1, real=True)
+        self.spectra = [None] * len(metric_list)
+        self.norms = [None] * len(metric_list)
+        self.cumsums = [None] * len(metric_list)
+        self.coarse = None
+        if decimate > 1:
+            coarse_list = []
+            for metric in metric_list:
+                coarse_list.append( decimate_metric(metric, decimate) )
+            if max_lag is None:
+                coarse_lag = None
+            else:
+                coarse_lag = int(math.ceil(max_lag / decimate)) + 1
+            self.coarse = FFTCorrelator(coarse_list, max_lag=coarse_lag,
+                                        exclude=max(2, exclude // decimate))
+
+    def spectrum(self, i):
+        if self.spectra[i] is None:
+            metric = np.asarray(self.metric_list[i], dtype=float)
+            self.spectra[i] = fft.rfft(metric, n=self.nfft)
+        return self.spectra[i]
+
+    def norm(self, i):
+        if self.norms[i] is None:
+            metric = np.asarray(self.metric_list[i], dtype=float)
+            self.norms[i] = np.linalg.norm(metric)
+        return self.norms[i]
+
+    # running sum of a metric (with a leading 0)
+    def cumsum(self, i):
+        if self.cumsums[i] is None:
+            metric = np.asarray(self.metric_list[i], dtype=float)
+            self.cumsums[i] = np.concatenate([[0], np.cumsum(metric)])
+        return self.cumsums[i]
+
+    # the correlation ycorr (lags lo and up) turned into the correlation
+    # of the mean removed metrics, computed from running sums of the
+    # overlap at each lag.  Non-negative metrics (clarity, intensity)
+    # correlate into a broad triangle (the amount of overlap) that hides
+    # how sharp the real peak is, this takes it out.
+    def centered(self, i, j, ycorr, lo):
+        a = len(self.metric_list[i])
+        b = len(self.metric_list[j])
+        ca = self.cumsum(i)
+        cb = self.cumsum(j)
+        mean_a = ca[-1] / max(a, 1)
+        mean_b = cb[-1] / max(b, 1)
+        lag = lo + np.arange(len(ycorr))
+        # overlap: a[a0:a1] lines up with b[b0:b1]
+        a0 = np.clip(lag, 0, a)
+        a1 = np.clip(b + lag, 0, a)
+        b0 = np.clip(-lag, 0, b)
+        b1 = np.clip(a - lag, 0, b)
+        count = np.maximum(a1 - a0, 0)
+        sum_a = ca[a1] - ca[a0]
+        sum_b = cb[b1] - cb[b0]
+        return ycorr - mean_b * sum_a - mean_a * sum_b \
+            + mean_a * mean_b * count
+    #   np.correlate(metric_list[i], metric_list[j], mode='full')
+    def correlate(self, i, j):
+        a = len(self.metric_list[i])
+        b = len(self.metric_list[j])
+        circ = fft.irfft(self.spectrum(i) * np.conj(self.spectrum(j)),
+                         n=self.nfft)
+        # negative lags live at the end of the circular result
+        return np.concatenate([circ[self.nfft-(b-1):], circ[:a]])
+
+    # direct correlation for just the lags lo..hi (inclusive), this is
+    # the slice [lo+b-1:hi+b] of the 'full' correlation result
+    def correlate_window(self, i, j, lo, hi):
+        a = np.asarray(self.metric_list[i], dtype=float)
+        b = np.asarray(self.metric_list[j], dtype=float)
+        padded = padded_slice(a, lo, lo + len(b) + hi - lo)
+        return np.correlate(padded, b, mode='valid')
+
+    # range of lags to search (honoring max_lag)
+    def lag_bounds(self, i, j):
+        lo = -(len(self.metric_list[j]) - 1)
+        hi = len(self.metric_list[i]) - 1
+        if self.max_lag is not None:
+            lo = max(lo, -self.max_lag)
+            hi = min(hi, self.max_lag)
+        return lo, hi
+
+    # argmax of the correlation, but ties (within fft round off) resolve
+    # to the first index just like np.argmax() on the direct result
+    def peak_index(self, i, j, ycorr):
+        tol = 1e-10 * self.norm(i) * self.norm(j)
+        return int(np.flatnonzero(ycorr >= np.max(ycorr) - tol)[0])
+
+    # index of the best alignment in terms of the np.correlate(mode='full')
+    # result, (index - (len(metric_list[j]) - 1) is the lag), the peak to
+    # sidelobe ratio of that peak (how much it stands out from the rest
+    # of the correlation curve), and the index of the second best
+    # alignment (None if there isn't one.)  The psr and second best are
+    # taken from the mean removed correlation (see centered()).  With
+    # decimation they come from the coarse pass.
+    def search(self, i, j):
+        b = len(self.metric_list[j])
+        lo, hi = self.lag_bounds(i, j)
+        if self.coarse is None:
+            ycorr = self.correlate(i, j)
+            if lo != -(b - 1) or hi != len(ycorr) - b:
+                ycorr = ycorr[lo+b-1:hi+b]
+            index = self.peak_index(i, j, ycorr)
+            centered = self.centered(i, j, ycorr, lo)
+            psr = peak_ratio(centered, index, self.exclude)
+            second = second_peak(centered, index, self.exclude)
+            if second is not None:
+                second += lo + b - 1
+        else:
+            coarse_index, psr, coarse_second = self.coarse.search(i, j)
+            coarse_b = len(self.coarse.metric_list[j])
+            if coarse_second is None:
+                second = None
+            else:
+                second = (coarse_second - (coarse_b - 1)) * self.decimate \
+                    + b - 1
+            lag = (coarse_index - (coarse_b - 1)) * self.decimate
+            lo = max(lo, lag - 2*self.decimate)
+            hi = min(hi, lag + 2*self.decimate)
+            if lo > hi:
+                # coarse lag landed outside the legal range (can
+                # happen at the very edges), fall back to the full search
+                lo, hi = self.lag_bounds(i, j)
+            ycorr = self.correlate_window(i, j, lo, hi)
+            index = self.peak_index(i, j, ycorr)
+        return lo + b - 1 + index, psr, second
+
+    def best_index(self, i, j):
+        return self.search(i, j)[0]
+
+    # best_index() plus the sub-frame position of the peak found by
+    # interpolating the correlation curve around it, the peak to
+    # sidelobe ratio, and the index of the second best alignment
+    def best_peak(self, i, j):
+        index, psr, second = self.search(i, j)
+        lag = index - (len(self.metric_list[j]) - 1)
+        ycorr = self.correlate_window(i, j, lag - 1, lag + 1)
+        return index, parabolic_offset(ycorr, 1), psr, second
+
+# per worker process state, the metric arrays live in one shared
+# memory block so they are never pickled per pair.
+worker_shm = None
+worker_correlator = None
+
+def init_worker(shm_name, lengths, max_lag, decimate):
+    global worker_shm
+    global worker_correlator
+    worker_shm = shared_memory.SharedMemory(name=shm_name)
+    # the parent unlinks the block, each worker closes its own mapping
+    # when it exits
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+    buf = np.ndarray((int(np.sum(lengths)),), dtype=float,
+                     buffer=worker_shm.buf)
+    metric_list = []
+    base = 0
+    for n in lengths:
+        metric_list.append(buf[base:base+n])
+        base += n
+    worker_correlator = FFTCorrelator(metric_list, max_lag=max_lag,
+                                      decimate=decimate)
+
+def close_worker():
+    global worker_shm
+    global worker_correlator
+    # drop the arrays that view the block before closing it
+    worker_correlator = None
+    if worker_shm is not None:
+        worker_shm.close()
+        worker_shm = None
+
+def worker_peak(pair):
+    (i, j) = pair
+    return worker_correlator.best_peak(i, j)
+
+# return the peak correlation (index, fraction, psr, second best index)
+# for each (i, j) pair.
+# Results are returned in pair order and each pair is computed the same
+# way no matter which worker handles it, so the result does not depend
+# on the number of jobs.
+def correlate_pairs(metric_list, pairs, jobs=1, max_lag=None, decimate=1):
+    if jobs <= 1 or len(pairs) < 2:
+        correlator = FFTCorrelator(metric_list, max_lag=max_lag,
+                                   decimate=decimate)
+        result = []
+        for (i, j) in pairs:
+            result.append( correlator.best_peak(i, j) )
+        return result
+
+    lengths = [ len(metric) for metric in metric_list ]
+    total = int(np.sum(lengths))
+    shm = shared_memory.SharedMemory(create=True, size=max(total, 1) * 8)
+    try:
+        buf = np.ndarray((total,), dtype=float, buffer=shm.buf)
+        base = 0
+        for metric in metric_list:
+            buf[base:base+len(metric)] = metric
+            base += len(metric)
+        # contiguous chunks of (mostly) the same row let each worker
+        # reuse its cached spectra
+        chunksize = max(1, len(pairs) // (jobs * 4))
+        with multiprocessing.Pool(jobs, initializer=init_worker,
+                                  initargs=(shm.name, lengths, max_lag,
+                                            decimate)) as pool:
+            result = pool.map(worker_peak, pairs, chunksize=chunksize)
+            # let the workers exit normally (so they close the block)
+            # rather than being terminated
+            pool.close()
+            pool.join()
+        del buf
+    finally:
+        shm.close()
+        shm.unlink()
+    return result
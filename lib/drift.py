@@ -0,0 +1,160 @@
+# automatic tempo drift detection
+
+# A singer following a reference track that bogged down during playback
+# (or just drifting on their own) doesn't line up with the rest of the
+# group with one constant offset.  Here each track's metric (clarity) is
+# compared window by window against the consensus of all the other
+# tracks placed on the common timeline, searching only a narrow band of
+# lags around the track's global offset, so the cost is O(n * band)
+# rather than O(n^2).  The result for each track is a piecewise offset
+# map: a list of [track time, extra offset] steps (sec), starting at
+# track time 0, or an empty list if the track doesn't drift.
+
+import numpy as np
+from scipy import signal
+
+from .correlate import padded_slice, parabolic_offset, peak_ratio
+
+# place every (normalized) metric on the common timeline, returns the
+# start frame of each track on the timeline and the sum of them all
+def consensus(metric_list, offsets, dt):
+    shifts = [ int(round(offset / dt)) for offset in offsets ]
+    base = np.min(shifts)
+    starts = [ shift - base for shift in shifts ]
+    length = np.max([ start + len(metric) for start, metric in zip(starts, metric_list) ])
+    total = np.zeros(length)
+    normed = []
+    for start, metric in zip(starts, metric_list):
+        metric = np.asarray(metric, dtype=float)
+        std = np.std(metric)
+        if std > 0:
+            metric = metric / std
+        normed.append(metric)
+        total[start:start+len(metric)] += metric
+    return starts, normed, total
+
+# best lag (frames, nan where unreliable) of each window of a track
+# against the consensus of the other tracks
+def window_lags(metric, others, start, window, step, band, min_psr):
+    centers = []
+    lags = []
+    for w in range(0, max(len(metric) - window, 0) + 1, step):
+        seg = metric[w:w+window]
+        seg = seg - np.mean(seg)
+        p = start + w
+        chunk = padded_slice(others, p - band, p + len(seg) + band)
+        ycorr = signal.correlate(chunk, seg, mode='valid')
+        index = int(np.argmax(ycorr))
+        centers.append(w + len(seg) / 2)
+        if np.std(seg) <= 0 or index == 0 or index == len(ycorr) - 1 \
+           or peak_ratio(ycorr, index, 2) < min_psr:
+            # flat, ambiguous, or outside the band
+            lags.append(np.nan)
+        else:
+            lags.append(index - band + parabolic_offset(ycorr, index))
+    return np.array(centers), np.array(lags)
+
+# turn the window lags into steps (in frames): a new step starts
+# between two windows whenever the lag moves by tolerance frames or
+# more.  Lags within tolerance of zero are snapped to zero so the track
+# keeps its global (sample accurate) offset there.
+def lag_steps(centers, lags, tolerance, min_drift):
+    valid = ~np.isnan(lags)
+    if np.count_nonzero(valid) < 3:
+        return []
+    centers = centers[valid]
+    # median filter knocks out single window glitches
+    lags = signal.medfilt(lags[valid], 3)
+    lags[np.abs(lags) < tolerance] = 0
+    if np.max(np.abs(lags)) < min_drift:
+        return []
+    steps = [ [0, lags[0], 0] ]
+    for k in range(1, len(lags)):
+        if abs(lags[k] - steps[-1][1]) >= tolerance:
+            # the step happens somewhere between these window centers
+            steps.append( [centers[k-1], lags[k], centers[k]] )
+    return steps
+
+# find where between lo and hi (frames) a step from lag1 to lag2 really
+# happens: the split point that best matches the track to the consensus
+# with lag1 before it and lag2 after it (running sums make this O(n)).
+# The scores are correlations of the mean removed signals, normalized
+# so min_margin is how much (as a correlation coefficient) the best split
+# must beat keeping either lag throughout.  Returns None for a weaker step.
+def refine_step(metric, others, start, lo, hi, lag1, lag2, min_margin=0.02):
+    lo = int(lo)
+    hi = int(hi)
+    seg = metric[lo:hi] - np.mean(metric[lo:hi])
+    o1 = padded_slice(others, start + lo + int(round(lag1)),
+                      start + hi + int(round(lag1)))
+    o2 = padded_slice(others, start + lo + int(round(lag2)),
+                      start + hi + int(round(lag2)))
+    o1 = o1 - np.mean(o1)
+    o2 = o2 - np.mean(o2)
+    scale = np.sqrt(np.sum(seg*seg) * max(np.sum(o1*o1), np.sum(o2*o2)))
+    if scale <= 0:
+        return None
+    p1 = seg * o1 / scale
+    p2 = seg * o2 / scale
+    # score of splitting before each frame
+    before = np.concatenate([[0], np.cumsum(p1)])
+    after = np.concatenate([np.cumsum(p2[::-1])[::-1], [0]])
+    score = before + after
+    best = int(np.argmax(score))
+    if score[best] - max(score[0], score[-1]) < min_margin:
+        return None
+    return lo + best
+
+def detect_drift(metric_list, offsets, dt, window_sec=20, step_sec=10,
+                 band_sec=1.0, min_psr=4, tolerance=0.04, min_drift=0.08,
+                 min_margin=0.02):
+    if len(metric_list) < 2:
+        return [ [] for metric in metric_list ]
+    window = int(round(window_sec / dt))
+    step = int(round(step_sec / dt))
+    band = int(round(band_sec / dt))
+    starts, normed, total = consensus(metric_list, offsets, dt)
+    drift_list = []
+    for i in range(len(metric_list)):
+        others = total.copy()
+        others[starts[i]:starts[i]+len(normed[i])] -= normed[i]
+        centers, lags = window_lags(normed[i], others, starts[i], window,
+                                    step, band, min_psr)
+        steps = lag_steps(centers, lags, tolerance / dt, min_drift / dt)
+        result = []
+        prev = None
+        for k, (lo, lag, hi) in enumerate(steps):
+            if k == 0:
+                split = 0
+            else:
+                split = refine_step(normed[i], others, starts[i], lo, hi,
+                                    prev, lag, min_margin)
+                if split is None:
+                    # no clear split point, keep the previous lag
+                    continue
+            result.append( [float(split * dt), float(lag * dt)] )
+            prev = lag
+        if len(result) == 1 and result[0][1] == 0:
+            # only the global offset is left
+            result = []
+        drift_list.append(result)
+    return drift_list
+
+# time in the track (sec) to show at time t (sec, relative to the track
+# start without drift correction.)  In a gap opened by a step the last
+# frame before the step is held, where a step overlaps the track skips
+# ahead.
+def local_time(steps, t):
+    if not len(steps):
+        return t
+    local = t - steps[0][1]
+    for k in range(1, len(steps)):
+        (t_k, d_k) = steps[k]
+        if t >= t_k + d_k:
+            local = t - d_k
+        elif local > t_k:
+            local = t_k
+            break
+        else:
+            break
+    return local
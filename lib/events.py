@@ -0,0 +1,43 @@
+# sparse onset event alignment
+
+# Rather than correlating dense per frame arrays, pick the strongest few
+# hundred onset peaks of each track and find the offset between two
+# tracks as the most common difference between their event times (the
+# mode of a histogram of all k^2 pairwise differences.)  With k in the
+# hundreds this is far cheaper than a correlation of whole envelopes.
+
+import numpy as np
+from scipy import signal
+
+from .correlate import peak_ratio
+
+# times (sec) of the k strongest onset peaks of a track (at least
+# min_sep sec apart), in time order
+def onset_events(onset, dt, k=300, min_sep=0.1):
+    onset = np.asarray(onset, dtype=float)
+    distance = max(1, int(round(min_sep / dt)))
+    peaks, props = signal.find_peaks(onset, distance=distance, height=0)
+    if len(peaks) > k:
+        strongest = np.argpartition(props["peak_heights"], -k)[-k:]
+        peaks = np.sort(peaks[strongest])
+    return peaks * dt
+
+# offset (sec) of track a relative to track b (an event at time t in b
+# shows up at t + offset in a) and a confidence (peak to sidelobe ratio
+# of the histogram mode)
+def event_offset(ta, tb, bin_width, max_offset=None):
+    if not len(ta) or not len(tb):
+        return 0.0, 0.0
+    diff = (np.asarray(ta)[:,np.newaxis] - np.asarray(tb)[np.newaxis,:]).ravel()
+    if max_offset is not None:
+        diff = diff[np.abs(diff) <= max_offset]
+    if not len(diff):
+        return 0.0, 0.0
+    lo = np.floor(np.min(diff) / bin_width)
+    bins = (np.floor(diff / bin_width) - lo).astype(int)
+    # sum neighboring bins so an offset near a bin edge isn't split in two
+    counts = np.convolve(np.bincount(bins), np.ones(3), mode='same')
+    index = int(np.argmax(counts))
+    # sub bin estimate from the differences that voted for the mode
+    offset = float(np.median(diff[np.abs(bins - index) <= 1]))
+    return offset, peak_ratio(counts.astype(float), index, 2)
@@ -0,0 +1,58 @@
+# per track feature store
+
+# All the analysis features of a track (mono/filtered signal, onset
+# envelope, intensity, chroma, clarity, notes, rms) live together in one
+# directory per track in the group cache.  Each feature is its own .npy
+# file, so it can be memory mapped and read partially.  A manifest in
+# the same directory versions each feature by the content hash of the
+# source track plus the parameters it was extracted with, and a feature
+# made from a different source or with different parameters is never
+# returned.
+
+import numpy as np
+import os
+
+from .manifest import Manifest
+
+class FeatureStore():
+    def __init__(self, cache_dir, file, source_hash):
+        basename, ext = os.path.splitext(os.path.basename(file))
+        self.dir = os.path.join(cache_dir, "features", basename)
+        os.makedirs(self.dir, exist_ok=True)
+        self.source_hash = source_hash
+        self.manifest = Manifest(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name + ".npy")
+
+    def has(self, name, params):
+        return self.manifest.is_current(name, self.source_hash, params,
+                                        self.path(name))
+
+    # the stored feature (memory mapped unless mmap is False), or None if
+    # it isn't stored or was made with different parameters
+    def load(self, name, params, mmap=True):
+        if not self.has(name, params):
+            return None
+        if mmap:
+            return np.load(self.path(name), mmap_mode='r')
+        else:
+            return np.load(self.path(name))
+
+    def save(self, name, params, value):
+        np.save(self.path(name) + ".tmp.npy", value)
+        self.commit(name, params)
+
+    # writable (memory mapped) array to fill in a feature piece by piece,
+    # close it and commit() it when done
+    def create(self, name, shape, dtype):
+        return np.lib.format.open_memmap(self.path(name) + ".tmp.npy",
+                                         mode='w+', dtype=dtype, shape=shape)
+
+    # a feature is written to a temp file first and only replaces the
+    # stored version here, so an interrupted run never leaves a partial
+    # feature behind that looks current
+    def commit(self, name, params):
+        os.replace(self.path(name) + ".tmp.npy", self.path(name))
+        self.manifest.update(name, self.source_hash, params)
+        self.manifest.save()
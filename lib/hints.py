@@ -3,6 +3,9 @@ import os
 
 from .logger import log
 
+# hints under this name apply to the whole project (i.e. max_offset)
+project_name = "*"
+
 def load(path):
     hints_file = os.path.join(path, "hints.txt")
     hints = {}
@@ -31,7 +34,7 @@ def load(path):
                 if not name in hints:
                     hints[name] = {}
                 hint = row[1]
-                if hint in [ "face_detect", "gain", "rotate", "video_shift", "video_hide" ]:
+                if hint in [ "face_detect", "gain", "rotate", "video_shift", "video_hide", "max_offset" ]:
                     hints[name][hint] = float(row[2])
                 elif hint == "suppress":
                     if "suppress" in hints[name]:
@@ -52,7 +55,10 @@ def validate( hints, audio_tracks, video_tracks ):
         hint_names.add(name)
     errors = False
     for name in hints.keys():
-        if not name in hint_names:
+        if name == project_name:
+            # project wide hints
+            pass
+        elif not name in hint_names:
             log("  Error: file name in hints.txt file not found in project:", name)
             errors = True
     if errors:
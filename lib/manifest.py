@@ -0,0 +1,71 @@
+# cache manifest
+
+# Records, for every derived artifact in a cache directory, a signature
+# made from the content hash of the source it was derived from plus the
+# parameters used to make it.  An artifact is reused only if its
+# signature still matches, so cache decisions don't depend on file
+# modification times (which change whenever a cloud drive re-syncs a
+# folder, even if nothing really changed.)
+
+import hashlib
+import json
+import os
+
+from .logger import log
+
+class Manifest():
+    def __init__(self, cache_dir):
+        self.file = os.path.join(cache_dir, "manifest.json")
+        self.entries = {}
+        self.changes = {}
+        if os.path.exists(self.file):
+            try:
+                with open(self.file, "r") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                log("NOTICE: ignoring unreadable cache manifest:", self.file)
+                log(str(e))
+
+    def signature(self, source_hash, params):
+        h = hashlib.sha1()
+        h.update(source_hash.encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    # true if the artifact (and its file if a path is given) was made
+    # from this source with these parameters
+    def is_current(self, key, source_hash, params={}, path=None):
+        if path is not None and not os.path.exists(path):
+            return False
+        if not key in self.entries:
+            return False
+        return self.entries[key] == self.signature(source_hash, params)
+
+    def update(self, key, source_hash, params={}):
+        sig = self.signature(source_hash, params)
+        self.entries[key] = sig
+        self.changes[key] = sig
+
+    # store a plain value (not a signature) under key
+    def record(self, key, value):
+        self.entries[key] = value
+        self.changes[key] = value
+
+    # merge changes made elsewhere (i.e. in a worker process)
+    def merge(self, changes):
+        self.entries.update(changes)
+        self.changes.update(changes)
+
+    def save(self):
+        if not len(self.changes):
+            return
+        # merge with whatever is on disk now, then replace atomically
+        current = Manifest(os.path.dirname(self.file))
+        current.entries.update(self.changes)
+        # (per process temp name, worker processes may save concurrently)
+        tmp = self.file + ".%d.tmp" % os.getpid()
+        with open(tmp, "w") as f:
+            json.dump(current.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.file)
+        self.entries = current.entries
+        self.changes = {}
@@ -3,18 +3,79 @@ import numpy as np
 import os
 from pydub import AudioSegment, playback  # pip install pydub
 import random
+from scipy import signal
 
+from .analyze import sample_rate
 from .logger import log
 
+# delay (or advance) a sample by offset seconds with sub-sample
+# accuracy: whole samples are padded/trimmed and the remaining fraction
+# of a sample is applied with a windowed sinc fractional delay filter.
+def delay_sample(sample, offset, taps=32):
+    sr = sample.frame_rate
+    y = np.array(sample.get_array_of_samples()).astype('double')
+    y = y.reshape(-1, sample.channels)
+    delay = offset * sr
+    whole = int(math.floor(delay))
+    frac = delay - whole
+    if frac > 0.0001:
+        center = taps // 2 - 1
+        h = np.sinc(np.arange(taps) - center - frac) * np.blackman(taps)
+        h /= np.sum(h)
+        y = signal.oaconvolve(y, h[:,np.newaxis], mode='full', axes=0)
+        y = y[center:center+len(y)-taps+1]
+    if whole < 0:
+        y = y[-whole:]
+    else:
+        y = np.concatenate([np.zeros((whole, sample.channels)), y])
+    y = np.int16(np.clip(np.round(y), -32768, 32767))
+    return sample._spawn(y.tobytes())
+
+# apply a piecewise offset map (drift steps, see drift.py) to a sample:
+# where the offset grows a gap of silence is opened, where it shrinks the
+# overlap is crossfaded away.  Returns the new sample and the offset of
+# the first step (to be added to the track offset.)
+def warp_sample(sample, steps, blend=50):
+    if not len(steps):
+        return sample, 0
+    new_sample = sample
+    for k in range(1, len(steps)):
+        (t, d) = steps[k]
+        prev = steps[k-1][1]
+        # position of track time t in the sample so far (ms)
+        at = int(round((t + prev - steps[0][1]) * 1000))
+        delta = int(round((d - prev) * 1000))
+        if delta == 0 or at <= 0 or at >= len(new_sample):
+            continue
+        begin = new_sample[:at]
+        end = new_sample[at:]
+        if delta < 0:
+            # snip (crossfade over the overlap)
+            fade = int(np.min([-delta, len(begin), len(end)]))
+            new_sample = begin.append(end, crossfade=fade)
+        else:
+            # pad
+            fade = int(np.min([blend, len(begin), len(end)]))
+            gap = AudioSegment.silent(duration=delta + 2*fade,
+                                      frame_rate=sample.frame_rate)
+            new_sample = begin.append(gap, crossfade=fade)
+            new_sample = new_sample.append(end, crossfade=fade)
+    return new_sample, steps[0][1]
+
 def combine(group, sync_offsets, mute_tracks,
             hints={}, pan_range=0, suppress_silent_zones=False):
     durations_ms = []
-    for i, sample in enumerate(group.sample_list):
+    for i, raw in enumerate(group.sample_list):
         name = os.path.basename(group.name_list[i])
         offset = sync_offsets[name]["offset"]
         print(name, offset)
-        # print(group.name_list[i], len(sample) / 1000, sync_offsets[i])
-        durations_ms.append( len(sample) + offset )
+        # print(group.name_list[i], len(raw), sync_offsets[i])
+        if "drift" in sync_offsets[name] and len(sync_offsets[name]["drift"]):
+            # warp_sample() moves the end of the track by the last step
+            # of its drift map (the first step shifts the start, the
+            # splices shift everything after them)
+            offset += sync_offsets[name]["drift"][-1][1]
+        durations_ms.append( (len(raw) / sample_rate + offset) * 1000 )
     duration_ms = np.median(durations_ms)
     log("median audio duration (sec):", duration_ms / 1000)
 
@@ -45,16 +106,15 @@ def combine(group, sync_offsets, mute_tracks,
     
     y_mixed = None
     mixed_count = 0
+    group.aligned_list = [None] * len(group.name_list)
+    group.mix_raw = None
     for i, file in enumerate(group.name_list):
         name = os.path.basename(group.name_list[i])
         offset = sync_offsets[name]["offset"]
-        basefile, ext = os.path.splitext(name)
-        canon_name = os.path.join("cache", basefile + "-canon.mp3")
-        clean_name = os.path.join("cache", basefile + "-clean.mp3")
-        print("names:", canon_name, clean_name)
-        sample = group.load(clean_name)
+        # from the lossless canonical store (noise reduced if available)
+        sample = group.canonical_sample(file, "clean")
         if sample is None:
-            sample = group.load(canon_name)
+            sample = group.canonical_sample(file, "canon")
         if sample is None:
             log("cannot find cached canonical audio or cleaned audio, die!")
             quit()
@@ -83,7 +143,7 @@ def combine(group, sync_offsets, mute_tracks,
             sample = sample.pan( random.uniform(-pan_range, pan_range) )
         commands = []
         if not group.suppress_list is None:
-            commands = group.suppress_list[i]
+            commands = group.suppress_list[i].tolist()
         # add hints (offset relative to track 0) to suppress list
         if name in hints and "suppress" in hints[name]:
             print(hints[name]["suppress"])
@@ -125,16 +185,16 @@ def combine(group, sync_offsets, mute_tracks,
                 # sample = sample.normalize()
                 # don't do this because we are using rms to do scaling now
         sr = sample.frame_rate
-        sync_ms = int(round(offset * 1000))
-        if sync_ms < 0:
-            synced_sample = sample[-sync_ms:]
-        else:
-            pad = AudioSegment.silent(duration=sync_ms)
-            synced_sample = pad + sample
+        if "drift" in sync_offsets[name]:
+            log("  applying drift correction:", sync_offsets[name]["drift"])
+            sample, drift_offset = warp_sample(sample,
+                                               sync_offsets[name]["drift"])
+            offset += drift_offset
+        synced_sample = delay_sample(sample, offset)
         # trim end for length
         synced_sample = synced_sample[:duration_ms]
         synced_sample = synced_sample.fade_out(1000)
-        group.sample_list[i] = synced_sample
+        group.aligned_list[i] = synced_sample
 
         y = np.array(synced_sample.get_array_of_samples()).astype('double')
         print(i, "max:", np.max(np.abs(y)))
@@ -168,6 +228,10 @@ def combine(group, sync_offsets, mute_tracks,
     #y_mixed /= math.pow(mixed_count, 0.6) # slightly more conservative
     #y_mixed / len(mixed_count) # very conservative output levels
     print("mixed max:", np.max(np.abs(y_mixed)))
+    # the lossless (float) mix as a (frames, channels) array, a parent
+    # group can take this directly instead of decoding the mp3 of it
+    if sr == sample_rate:
+        group.mix_raw = y_mixed.reshape(-1, sample.channels)
     y_mixed = np.int16(y_mixed)
     mixed = AudioSegment(y_mixed.tobytes(), frame_rate=sr, sample_width=2, channels=sample.channels)
     #mixed = mixed.normalize()
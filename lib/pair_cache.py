@@ -0,0 +1,64 @@
+# persistent cache of pairwise track offsets
+
+# Each pair is keyed by the content hashes of the two source files plus
+# the feature/search parameters used to compute it, so when a late
+# singer uploads a file only the pairs involving new or changed tracks
+# need to be correlated again.
+
+import hashlib
+import json
+import os
+
+from .logger import log
+
+class PairCache():
+    def __init__(self, cache_dir, params):
+        self.file = os.path.join(cache_dir, "pairs.json")
+        self.params = json.dumps(params, sort_keys=True)
+        self.pairs = {}
+        self.dirty = False
+        if os.path.exists(self.file):
+            try:
+                with open(self.file, "r") as f:
+                    self.pairs = json.load(f)
+            except Exception as e:
+                log("NOTICE: ignoring unreadable pair cache:", self.file)
+                log(str(e))
+
+    def key(self, hash_a, hash_b):
+        h = hashlib.sha1()
+        h.update((hash_a + hash_b + self.params).encode())
+        return h.hexdigest()
+
+    # return (offset, weight, second best offset, fallback) for the pair
+    # or None if not cached (the second best offset is None if unknown,
+    # fallback names the method that replaced a weak correlation, if any)
+    def get(self, hash_a, hash_b):
+        key = self.key(hash_a, hash_b)
+        if key in self.pairs:
+            pair = self.pairs[key]
+            return pair["offset"], pair["weight"], pair.get("second"), \
+                pair.get("fallback")
+        # same pair the other way around
+        key = self.key(hash_b, hash_a)
+        if key in self.pairs:
+            pair = self.pairs[key]
+            second = pair.get("second")
+            if second is not None:
+                second = -second
+            return -pair["offset"], pair["weight"], second, \
+                pair.get("fallback")
+        return None
+
+    def put(self, hash_a, hash_b, offset, weight, second=None,
+            fallback=None):
+        key = self.key(hash_a, hash_b)
+        self.pairs[key] = { "offset": offset, "weight": weight,
+                            "second": second, "fallback": fallback }
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            with open(self.file, "w") as f:
+                json.dump(self.pairs, f)
+            self.dirty = False
@@ -1,6 +1,8 @@
+import hashlib
 import os
 
 from .logger import log
+from .manifest import Manifest
 
 # find all the project clips (todo: recurse)
 audio_extensions = [ "aac", "aif", "aiff", "flac", "m4a", "mp3", "ogg", "wav" ]
@@ -122,18 +124,69 @@ def is_newer(a, b):
             return True
     return False
 
-# scan a directory for the things (does not recurse)
+# content hash of the inputs of a group directory (does not recurse):
+# the names and contents of all its regular files.  Sub directories are
+# the cache/results or sub groups, and a sub group is represented here
+# by its own mix file.  Files written back into the directory by
+# processing are skipped.
+def inputs_hash(path):
+    h = hashlib.sha1()
+    for file in sorted(os.listdir(path)):
+        fullname = os.path.join(path, file)
+        if os.path.isdir(fullname):
+            continue
+        if file.endswith("_audacity_import.lof"):
+            continue
+        h.update(file.encode())
+        h.update(file_hash(fullname).encode())
+    return h.hexdigest()
+
+# return true if the inputs of a group directory changed since ref_file
+# was generated from them (or ref_file doesn't exist)
 def check_for_newer(path, ref_file):
     if not os.path.exists(ref_file):
         print("no ref file, need to process")
         return True
-    for file in sorted(os.listdir(path)):
-        fullname = os.path.join(path, file)
-        if os.path.isdir(fullname) and file == "results":
-            # don't consider newer files in the results dir a reason
-            # to flag a dependency is newer
-            print("ignoring:", fullname)
-        elif is_newer(fullname, ref_file):
-            print(fullname, "is newer than", ref_file)
-            return True
+    manifest = Manifest(os.path.join(path, "cache"))
+    key = "group:" + os.path.basename(ref_file)
+    if not manifest.is_current(key, inputs_hash(path)):
+        print("inputs of", path, "changed since", ref_file, "was made")
+        return True
     return False
+
+# record the inputs ref_file was just generated from
+def record_inputs(path, ref_file):
+    cache_dir = os.path.join(path, "cache")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    manifest = Manifest(cache_dir)
+    manifest.update("group:" + os.path.basename(ref_file), inputs_hash(path))
+    manifest.save()
+
+# content hash of a file.  Memoized by size and modification time, in
+# memory and in the cache manifest of the file's directory, so a file is
+# only read again (in this run or any later one) when its size or
+# modification time changes.
+hash_memo = {}
+def file_hash(path):
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key in hash_memo:
+        return hash_memo[key]
+    cache_dir = os.path.join(os.path.dirname(path), "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = Manifest(cache_dir)
+    memo_key = "hash:" + os.path.basename(path)
+    stamp = "%d:%d:" % (stat.st_size, stat.st_mtime_ns)
+    entry = manifest.entries.get(memo_key)
+    if isinstance(entry, str) and entry.startswith(stamp):
+        hash_memo[key] = entry[len(stamp):]
+        return hash_memo[key]
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    hash_memo[key] = h.hexdigest()
+    manifest.record(memo_key, stamp + hash_memo[key])
+    manifest.save()
+    return hash_memo[key]
@@ -25,6 +25,19 @@ def parse_lof(lof_file, dir_offset, pretty_path):
     print("offsets:", offsets)
     return offsets
 
+# attach the drift maps (piecewise offsets found by the automatic drift
+# detection) saved in a group's cache to its track offsets
+def add_drift(dir, offsets, pretty_path):
+    drift_file = os.path.join(dir, "cache", "drift.json")
+    if not os.path.exists(drift_file):
+        return
+    with open(drift_file, 'r') as fp:
+        drift_map = json.load(fp)
+    for name in drift_map:
+        key = os.path.join(pretty_path, name)
+        if key in offsets:
+            offsets[key]["drift"] = drift_map[name]
+
 def parse_json(json_file, dir_offset, pretty_path, audio_tracks=None):
     print("parse json:", json_file)
     if not os.path.exists(json_file):
@@ -59,7 +72,10 @@ def parse_json(json_file, dir_offset, pretty_path, audio_tracks=None):
     print("json offsets:", offsets)
     return offsets
 
-def build_offset_map(path):
+# groups: offsets of the groups synced in this run, kept in memory as
+# { dir: { track name: { "offset": sec, "drift": steps } } }.  Groups
+# not in there are read back from their .json/.lof sync files.
+def build_offset_map(path, groups={}):
     offsets = {}
     dirs = scan.work_directories(path, order="top_down")
     remove = len(dirs[0])            # hacky
@@ -80,6 +96,12 @@ def build_offset_map(path):
         else:
             dir_offset = 0.0
         print(dir, basename, dir_offset)
+        if dir in groups:
+            for name in groups[dir]:
+                entry = dict(groups[dir][name])
+                entry["offset"] += dir_offset
+                offsets[os.path.join(pretty_path, name)] = entry
+            continue
         sync_file = scan.find_extension(dir, "json")
         lof_file = scan.find_extension(dir, "lof")
         if sync_file:
@@ -87,6 +109,7 @@ def build_offset_map(path):
             offsets.update( result )
         elif lof_file:
             result = parse_lof( lof_file, dir_offset, pretty_path )
+            add_drift( dir, result, pretty_path )
             offsets.update( result )
         else:
             log("no sync source .lof or sync.json, can't continue with video:", dir)
@@ -8,7 +8,9 @@ import skvideo.io               # pip install sk-video
 from subprocess import call
 from tqdm import tqdm
 
+from . import drift
 from .logger import log
+from . import mixer
 from . import video_crop
 from . import video_faces
 from .video_track import VideoTrack
@@ -45,7 +47,8 @@ def render_combined_video(project, resolution, results_dir,
                           video_names, offsets, hints={}, rows=None,
                           crop='face',
                           title_page=None, credits_page=None,
-                          pad_bottom=0, pad_top=0, pad_left=0, pad_right=0):
+                          pad_bottom=0, pad_top=0, pad_left=0, pad_right=0,
+                          drifts=None):
     if resolution == '480p':
         output_w = 854
         output_h = 480
@@ -183,6 +186,9 @@ def render_combined_video(project, resolution, results_dir,
                 if "face_detect" in hints[basename]:
                     face_detect = hints[basename]["face_detect"]
             local_time = output_time - offsets[i] - video_shift
+            if drifts is not None:
+                # frame time remap for drift corrected tracks
+                local_time = drift.local_time(drifts[i], local_time)
             v.get_frame(local_time, rotate)
 
         # compute placement/size for each video frame (static grid strategy)
@@ -337,7 +343,34 @@ def merge(project, results_dir):
 
 #ffmpeg -f lavfi -i color=c=black:s=1920x1080:r=25:d=1 -i testa444.mov -filter_complex "[0:v] trim=start_frame=1:end_frame=5 [blackstart]; [0:v] trim=start_frame=1:end_frame=3 [blackend]; [blackstart] [1:v] [blackend] concat=n=3:v=1:a=0[out]" -map "[out]" -c:v qtrle -c:a copy -timecode 01:00:00:00 test16.mov
 
-def save_aligned(project, results_dir, video_names, sync_offsets):
+# scale/crop a source frame for the aligned videos (1280x720)
+def process_aligned_frame(frame):
+    (h, w) = frame.shape[:2]
+    vid_aspect = w/h
+    vid_landscape = (vid_aspect >= 1)
+    scale_w = 1280 / w
+    scale_h = 720 / h
+    background = None
+    if not vid_landscape:
+        # background/wings full zoom
+        background = video_crop.get_zoom(frame, scale_w, scale_h)
+        background = cv2.blur(background, (43, 43))
+        background = video_crop.clip_frame(background, 1280, 720)
+        # foreground compromise zoom/fit/arrangement
+        avg = (scale_w + scale_h) * 0.5
+        scale_w = avg
+        scale_h = avg
+        #print("scale:", scale_w, scale_h)
+    frame = video_crop.get_zoom(frame, scale_w, scale_h)
+    frame = video_crop.clip_frame(frame, 1280, 720)
+    if not background is None:
+        frame = video_crop.overlay_frames(background, frame)
+    return frame
+
+# drifts (optional): the drift map of each video (see drift.py), applied
+# to the frames and the audio the same way the renderer and the mixer do
+def save_aligned(project, results_dir, video_names, sync_offsets,
+                 drifts=None):
     if False:
         # first clean out any previous aligned_audio tracks in case tracks
         # have been updated or added or removed since the previous run.
@@ -351,14 +384,9 @@ def save_aligned(project, results_dir, video_names, sync_offsets):
     for i, video in enumerate(video_names):
         print(video, sync_offsets[i])
         video_file = os.path.join(project, video)
-        # decide trim/pad
-        sync_ms = sync_offsets[i] * 1000
-        if sync_offsets[i] < 0:
-            trim_sec = -sync_offsets[i]
-            pad_sec = 0
-        else:
-            trim_sec = 0
-            pad_sec = sync_offsets[i]
+        steps = []
+        if drifts is not None:
+            steps = drifts[i]
         
         # scan video meta data for resolution/fps
         metadata = skvideo.io.ffprobe(video_file)
@@ -401,62 +429,45 @@ def save_aligned(project, results_dir, video_names, sync_offsets):
         inputdict, outputdict = gen_dicts(fps, "sane")
         writer = skvideo.io.FFmpegWriter(tmp_video, inputdict=inputdict, outputdict=outputdict)
 
-        # pad or trim
-        pad_frames = 0
-        if pad_sec > 0:
-            pad_frames = int(round(fps*pad_sec))
-            log("  pad (sec):", pad_sec, "frames:", pad_frames)
-                
-        trim_frames = 0
-        if trim_sec > 0:
-            trim_frames = int(round(fps*trim_sec))
-            log("  trim (sec):", trim_sec, "frames:", trim_frames)
-            for j in range(trim_frames):
-                reader._readFrame() # discard
-
-        # copy remainder of video
-        pbar = tqdm(total=(total_frames+pad_frames-trim_frames), smoothing=0.05)
+        # output frame n shows the source frame at the (drift corrected)
+        # local time of n / fps: black before the track starts, source
+        # frames skipped for a trim (or an overlap), held for a gap
+        pbar = tqdm(total=max(int(round(total_frames + fps*sync_offsets[i])), 0),
+                    smoothing=0.05)
+        black = np.zeros((720, 1280, 3), dtype=np.uint8)
+        out_frame = 0
+        src_frame = -1
+        frame = None
         while True:
+            local = drift.local_time(steps, out_frame / fps - sync_offsets[i])
+            want = int(round(local * fps))
+            if want < 0:
+                writer.writeFrame(black)
+                out_frame += 1
+                pbar.update(1)
+                continue
             try:
-                frame = reader._readFrame()
-                if not len(frame):
-                    frame = None
-                else:
-                    (h, w) = frame.shape[:2]
-                    vid_aspect = w/h
-                    vid_landscape = (vid_aspect >= 1)
-                    scale_w = 1280 / w
-                    scale_h = 720 / h
-                    background = None
-                    if not vid_landscape:
-                        # background/wings full zoom
-                        background = video_crop.get_zoom(frame, scale_w, scale_h)
-                        background = cv2.blur(background, (43, 43))
-                        background = video_crop.clip_frame(background,
-                                                           1280, 720)
-                        # foreground compromise zoom/fit/arrangement
-                        avg = (scale_w + scale_h) * 0.5
-                        scale_w = avg
-                        scale_h = avg
-                        #print("scale:", scale_w, scale_h)
-                    frame = video_crop.get_zoom(frame, scale_w, scale_h)
-                    frame = video_crop.clip_frame(frame, 1280, 720)
-                    if not background is None:
-                        frame = video_crop.overlay_frames(background, frame)
+                if src_frame < want:
+                    # read up to the wanted frame (otherwise hold the
+                    # current one)
+                    while src_frame < want:
+                        raw = reader._readFrame()
+                        src_frame += 1
+                        if not len(raw):
+                            break
+                    if len(raw):
+                        frame = process_aligned_frame(raw)
+                    else:
+                        frame = None
             except Exception as e:
                 log("NOTICE: error reading frame for:", video_file)
                 log(str(e))
                 frame = None
             if frame is None:
                 break
-            else:
-                while pad_frames:
-                    black = frame * 0
-                    writer.writeFrame(black)
-                    pad_frames -= 1
-                    pbar.update(1)
-                writer.writeFrame(frame)
-                pbar.update(1)
+            writer.writeFrame(frame)
+            out_frame += 1
+            pbar.update(1)
         reader.close()
         writer.close()
         pbar.close()
@@ -466,6 +477,8 @@ def save_aligned(project, results_dir, video_names, sync_offsets):
         if ext == ".mpeg" or ext == ".m4v":
             ext = ".mp4"
         sample = AudioSegment.from_file(video_file, ext[1:])
+        sample, drift_offset = mixer.warp_sample(sample, steps)
+        sync_ms = int(round((sync_offsets[i] + drift_offset) * 1000))
         if sync_ms < 0:
             synced_sample = sample[-sync_ms:]
         else:
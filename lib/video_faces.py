@@ -4,6 +4,8 @@ import os
 from tqdm import tqdm
 
 from .logger import log
+from .manifest import Manifest
+from . import scan
 from .video_track import VideoTrack
 
 # how many samples to take (more is better, but slower)
@@ -18,11 +20,16 @@ def find_faces(project, video_names, hints):
     else:
         faces = {}
 
+    # cached faces are reused only if the video content and the face
+    # search parameters are unchanged
+    cache_dir = os.path.join(project, "cache")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    manifest = Manifest(cache_dir)
+
     # let's find any missing faces
     for i, file in enumerate(video_names):
         basename = os.path.basename(file)
-        if basename in faces:
-            continue
         if basename in hints and "video_hide" in hints[basename]:
             log("not detecting faces in hidden video:", file)
             continue
@@ -31,6 +38,11 @@ def find_faces(project, video_names, hints):
             rotate = hints[basename]["rotate"]
 
         path = os.path.join(project, file)
+        source = scan.file_hash(path)
+        params = { "rotate": rotate, "num_samples": num_samples }
+        key = "faces:" + basename
+        if basename in faces and manifest.is_current(key, source, params):
+            continue
         v = VideoTrack()
         if not v.open(path):
             log("cannot open video:", file)
@@ -50,12 +62,14 @@ def find_faces(project, video_names, hints):
             time += dt
         pbar.close()
         faces[basename] = v.face.data
+        manifest.update(key, source, params)
         
         # save/cache face location data (each iteration so we can
         # restart if needed)
         face_file = os.path.join(project, "results", "faces.json")
         with open(face_file, "w") as fp:
             json.dump(faces, fp, indent=4)
+        manifest.save()
 
     # close our face preview window
     cv2.destroyAllWindows()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# benchmark the vectorized intensity and rms kernels against the
+# original per sample python loops on a 10 minute track (at the
+# analysis rate.)
+# (run from the top level project dir: ./sandbox/bench-features.py)
+
+import argparse
+import math
+import numpy as np
+import os
+import sys
+import time
+
+# lib lives in the top level project dir (the parent of this script's dir)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib import analyze
+
+parser = argparse.ArgumentParser(description='feature kernel benchmark')
+parser.add_argument('--minutes', type=float, default=10, help='track length')
+args = parser.parse_args()
+
+hop_length = analyze.analysis_hop
+
+def intensity_loop(raw):
+    intensity = []
+    base = 0
+    while base < len(raw):
+        intensity.append(np.max(np.abs(raw[base:base+hop_length])))
+        base += hop_length
+    return np.array(intensity).astype('float')
+
+def rms_loop(intensity):
+    num = len(intensity)
+    five_perc = np.sort(intensity)[int(round(num*0.05))]
+    threshold = 4 * five_perc
+    sum = 0
+    count = 0
+    for j in range(len(intensity)):
+        if intensity[j] >= threshold:
+            sum += intensity[j]*intensity[j]
+            count += 1
+    return math.sqrt(sum / count)
+
+def rms_vector(intensity):
+    threshold = 4 * analyze.low_percentile(intensity, 0.05)
+    active = intensity[intensity >= threshold]
+    return math.sqrt(np.mean(active*active))
+
+# fake a track: noise with a slow loudness envelope and some silence
+n = int(args.minutes * 60 * analyze.analysis_rate)
+t = np.arange(n) / analyze.analysis_rate
+env = np.clip(np.sin(2 * np.pi * t / 20), 0, None)
+raw = np.int16(np.random.normal(0, 3000, n) * env)
+print("track samples:", n)
+
+start = time.time()
+i1 = intensity_loop(raw)
+t1 = time.time() - start
+start = time.time()
+i2 = analyze.block_max(raw, hop_length)
+t2 = time.time() - start
+print("intensity loop: %.3f sec  vectorized: %.4f sec  speedup: %.0fx" % (t1, t2, t1/t2))
+print("  max difference:", np.max(np.abs(i1 - i2)))
+
+start = time.time()
+r1 = rms_loop(i2)
+t1 = time.time() - start
+start = time.time()
+r2 = rms_vector(i2)
+t2 = time.time() - start
+print("rms loop: %.3f sec  vectorized: %.4f sec  speedup: %.0fx" % (t1, t2, t1/t2))
+print("  rms:", r1, r2)
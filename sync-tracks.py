@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import librosa                  # pip install librosa
 import librosa.display
 import matplotlib.pyplot as plt
@@ -21,9 +22,15 @@ from lib import video
 
 parser = argparse.ArgumentParser(description='virtual choir')
 parser.add_argument('project', help='project folder')
-parser.add_argument('--sync', default='clarity', choices=['clarity', 'clap'],
+parser.add_argument('--sync', default='clarity', choices=['clarity', 'anchor', 'clap', 'onset'],
                     help='sync strategy')
+parser.add_argument('--anchors', type=int, default=8, help='number of anchor tracks for --sync anchor (large groups).')
 parser.add_argument('--reference', help='file name of declared refrence track')
+parser.add_argument('--search', default='full', choices=['full', 'coarse'],
+                    help='alignment search: full resolution, or coarse to fine (much faster on long pieces)')
+parser.add_argument('--max-offset', type=float, help='largest expected time offset (sec) between tracks.')
+parser.add_argument('--drift', action='store_true', help='detect tempo drift and correct it (splices the audio of drifting tracks.)')
+parser.add_argument('--jobs', type=int, default=1, help='number of worker processes for track correlation.')
 parser.add_argument('--suppress-noise', action='store_true', help='try to suppress extraneous noises.')
 parser.add_argument('--compression', action='store_true', help='dynamic range compression on final audio mix.')
 parser.add_argument('--reverb', default='light', choices=['none', 'light', 'medium', 'heavy'],
@@ -64,6 +71,11 @@ for dir in work_dirs:
 log("hints:", hint_dict)
 hints.validate( hint_dict, all_audio_tracks, all_video_tracks )
 
+max_offset = args.max_offset
+if max_offset is None and hints.project_name in hint_dict:
+    if "max_offset" in hint_dict[hints.project_name]:
+        max_offset = hint_dict[hints.project_name]["max_offset"]
+
 # make results directory (if it doesn't exist)
 results_dir = os.path.join(args.project, "results")
 if not os.path.exists(results_dir):
@@ -76,6 +88,20 @@ logger.init( os.path.join(results_dir, "report.txt") )
 if False and args.write_aligned_tracks:
     mixer.clear_aligned(results_dir)
 
+# track offsets of each group synced in this run, for the video
+group_offsets = {}
+
+# alignment quality report, one entry per group (groups that are
+# skipped because nothing changed keep their entry from the last run)
+alignment_file = os.path.join(results_dir, "alignment.json")
+alignment = {}
+if os.path.exists(alignment_file):
+    try:
+        with open(alignment_file, "r") as fp:
+            alignment = json.load(fp)
+    except Exception as e:
+        log("NOTICE: ignoring unreadable alignment report:", alignment_file)
+
 for dir in work_dirs:
     if dir == work_dirs[-1]:
         # last dir (top level)
@@ -92,21 +118,19 @@ for dir in work_dirs:
         continue
     
     # load audio tracks, normalize, and resample at common (highest) sample rate
-    audio_group = analyze.SampleGroup(dir)
+    audio_group = analyze.SampleGroup(dir, jobs=args.jobs,
+                                      search=args.search,
+                                      max_offset=max_offset,
+                                      hints=hint_dict)
     audio_group.scan()
     audio_group.load_samples()
     if not len(audio_group.sample_list):
         # nothing to do here
         log("No audio/video tracks in this group:", dir)
         continue
-    # generate mono version, set consistent sample rate, and filer for
-    # analysis step
-    audio_group.compute_raw()
-    audio_group.compute_onset()
-    audio_group.compute_intensities()
-    audio_group.compute_clarities()
-    audio_group.compute_envelopes(hints=hint_dict)
-    audio_group.compute_rms()
+    # the analysis features (mono/filtered signal, intensities,
+    # clarities, envelopes, ...) are computed on demand from here on, so
+    # only what the sync method and the mixer use gets computed
     audio_group.clean_noise(clean=clean)
 
     print("sync:", audio_group.sync_file)
@@ -130,20 +154,40 @@ for dir in work_dirs:
             #audio_group.correlate_to_reference(ref_index, audio_group.note_list, plot=True)
         elif args.sync == "clarity":
             log("Sync by mutual best fit")
-            audio_group.correlate_mutual(audio_group.clarity_list, plot=False)
+            audio_group.correlate_mutual("clarity", plot=False)
+        elif args.sync == "anchor":
+            log("Sync by best fit to anchor tracks")
+            audio_group.correlate_anchors("clarity", k=args.anchors,
+                                          plot=False)
         elif args.sync == "clap":
             log("Sync by lead in claps")
             audio_group.sync_by_claps(plot=False)
+        elif args.sync == "onset":
+            log("Sync by onset events")
+            audio_group.sync_by_onsets()
+        audio_group.refine_offsets()
+        if args.drift:
+            audio_group.detect_drift()
 
         log("Generating audacity_import.lof file")
         with open(os.path.join(dir, os.path.basename(dir) + "_audacity_import.lof"), 'w') as fp:
             for i in range(len(audio_group.offset_list)):
-                fp.write('file "%s" offset %.3f\n' % (audio_group.name_list[i], audio_group.offset_list[i]))
+                fp.write('file "%s" offset %.6f\n' % (audio_group.name_list[i], audio_group.offset_list[i]))
         sync_offsets = {}
         for i in range(len(audio_group.offset_list)):
             name = os.path.basename( audio_group.name_list[i] )
             offset = audio_group.offset_list[i]
             sync_offsets[name] = { "offset": offset }
+            if len(audio_group.drift_list) and len(audio_group.drift_list[i]):
+                sync_offsets[name]["drift"] = audio_group.drift_list[i]
+        if args.reference:
+            method = "reference"
+        else:
+            method = args.sync
+        alignment[os.path.relpath(dir, args.project)] = {
+            "method": method,
+            "tracks": audio_group.alignment_report()
+        }
     else:
         # we found an audacity project, let's read the sync offsets from that
         log("Found an sync file, using that for time syncs:",
@@ -151,6 +195,20 @@ for dir in work_dirs:
         sync_offsets = sync.parse_json(os.path.join(dir, audio_group.sync_file),
                                        0.0, "",
                                        audio_group.name_list)
+        tracks = {}
+        for name in sync_offsets:
+            tracks[name] = { "offset": sync_offsets[name]["offset"] }
+        alignment[os.path.relpath(dir, args.project)] = {
+            "method": "sync file",
+            "sync_file": audio_group.sync_file,
+            "tracks": tracks
+        }
+    with open(alignment_file, "w") as fp:
+        json.dump(alignment, fp, indent=4)
+    group_offsets[dir] = sync_offsets
+
+    # drift maps (if any) for the video renderer
+    audio_group.save_drift()
 
     if False:
         audio_group.gen_plots(sync_offsets=None)
@@ -204,23 +262,38 @@ for dir in work_dirs:
         mixed.export(group_file, format="mp3",
                      tags={'artist': 'Various', 'album': 'Virtual Choir Maker',
                            'comments': 'https://virtualchoir.flightgear.org'})
+        # the parent group aligns and mixes this sub group from the
+        # lossless mix rather than decoding the mp3 again
+        if audio_group.mix_raw is not None:
+            parent_group = analyze.SampleGroup(os.path.dirname(group_file))
+            parent_group.import_track(os.path.basename(group_file),
+                                      audio_group.mix_raw)
+            audio_group.mix_raw = None
 
     if args.write_aligned_tracks:
         log("Generating trimmed/padded tracks that start at a common aligned time.")
         # write trimmed/padded samples for 'easy' alignment
         mixer.save_aligned(results_dir, audio_group.name_list,
-                           audio_group.sample_list, mute_tracks)
+                           audio_group.aligned_list, mute_tracks)
+
+    # remember what this mix was made from so an unchanged group is
+    # skipped next time
+    scan.record_inputs(dir, group_file)
 
 if len(all_video_tracks) and not args.no_video:
-    offsets = sync.build_offset_map(args.project)
+    offsets = sync.build_offset_map(args.project, group_offsets)
     
     log("Generating gridded video", fancy=True)
     video_offsets = []
+    video_drifts = []
     for track in all_video_tracks:
         trackbase, ext = os.path.splitext(track)
+        steps = []
         if track in offsets:
             # from .lof file
             offset = offsets[track]["offset"]
+            if "drift" in offsets[track]:
+                steps = offsets[track]["drift"]
         elif trackbase in offsets:
             # audactiy info macro doesn't include ext
             offset = offsets[trackbase]["offset"]
@@ -228,14 +301,16 @@ if len(all_video_tracks) and not args.no_video:
             log("No offset found for:", track)
         print(track, offset)
         video_offsets.append(offset)
+        video_drifts.append(steps)
     if args.write_aligned_tracks:
         log("Generating trimmed/padded tracks that start at a common aligned time.")
         video.save_aligned(args.project, results_dir, all_video_tracks,
-                           video_offsets)
+                           video_offsets, drifts=video_drifts)
     # render the new combined video
     video.render_combined_video( args.project, args.resolution, results_dir,
                                  all_video_tracks, video_offsets,
-                                 hints=hint_dict, rows=args.rows,
+                                 hints=hint_dict, drifts=video_drifts,
+                                 rows=args.rows,
                                  crop=args.crop,
                                  title_page=title_page,
                                  credits_page=credits_page,